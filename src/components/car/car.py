@@ -2,8 +2,15 @@ from stmpy import Machine, Driver
 
 import paho.mqtt.client as mqtt
 import stmpy
-import json
 import logging
+import os
+import sys
+import zlib
+from engine import ChargeEngine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")) # see common/messages.py
+import messages
+from dispatch import Dispatcher
 
 # Configure the MQTT settings 
 MQTT_BROKER = "test.mosquitto.org"
@@ -16,13 +23,17 @@ CHARGER_TOPIC = "ttm4115/g11/chargers"
 logger = logging.getLogger("car_logger")
 
 class BatteryLogic:
-    def __init__(self, car_id, component):
+    def __init__(self, car_id, component, engine: ChargeEngine = None):
         self.car_id = car_id
         self.percentage = 10 # Assuming the battery is at 10 percent
         self.charger_id = None
         self.component: BatteryComponent = component
         self.mqtt_client = self.component.mqtt_client
 
+        # With a charge engine, the engine charges the battery instead of the update timer
+        self.engine = engine
+        self.engine_index = None if engine is None else engine.add(self.percentage)
+
         # Transitions
         transitions = [
             {"source": "initial", "target": "idle"},
@@ -34,7 +45,7 @@ class BatteryLogic:
         # States
         states = [
             {"name": "charging", "entry": "start_timer('update_timer', 500)"}
-        ]
+        ] if engine is None else []
 
         # State machine
         self.stm = stmpy.Machine(
@@ -51,27 +62,36 @@ class BatteryLogic:
 
     def on_charging(self):
         logger.debug("Car moved from state idle -> charging. Charging has started.")
+        if self.engine is not None:
+            self.engine.start_charging(self.engine_index, self.percentage)
 
 
     def on_charging_update(self):
         if self.percentage < 99: # prevent going over 100% because its not possible
             self.percentage += 2
         logger.info(f"Charging percentage updated to {self.percentage}.")
+        self.send_battery_update()
 
-        # Send battery percentage to charger
+
+    def send_battery_update(self):
+        ''' Send battery percentage to charger '''
         topic = f"{CHARGER_TOPIC}/{self.charger_id}"
-        payload = {"command": "battery_update", "percentage": self.percentage}
-        payload = json.dumps(payload)
+        payload = messages.encode(messages.BatteryUpdate(self.percentage))
         self.mqtt_client.publish(topic, payload)
         logger.debug(f"Sent battery update to topic '{topic}' with payload {payload}")
 
 
     def on_finish_charging(self):
+        if self.engine is not None:
+            self.percentage = self.engine.stop_charging(self.engine_index)
         logger.debug(f"Car moved from state charging -> idle. Charging has finished with battery_percentage={self.percentage}%")
 
 
 class BatteryComponent:
     def __init__(self, car_id):
+        # Messages are handled by the dispatcher thread, started when the state machine is ready
+        self.dispatcher = Dispatcher(self.dispatch, logger)
+
         # mqtt definitions
         self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
         self.mqtt_client.on_connect = self.on_connect
@@ -87,6 +107,7 @@ class BatteryComponent:
         self.stm_driver = stmpy.Driver()
         self.stm_driver.start(keep_active=True)
         self.stm_driver.add_machine(self.battery.stm)
+        self.dispatcher.start()
 
         # other variables
         self.charger_id = None
@@ -94,20 +115,142 @@ class BatteryComponent:
 
     def on_message(self, client, userdata, msg):
         logger.debug(f"MQTT Client recieved a message in topic '{msg.topic}': {msg.payload}")
-        msg = json.loads(msg.payload)  # now a dict
+        self.dispatcher.put(msg.topic, msg.payload)
+
+    def dispatch(self, topic, payload):
+        handle_message(self.battery, payload)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.debug(f"Client connected to broker {MQTT_BROKER}:{MQTT_PORT}.")
+        else:
+            logger.debug(f"Broker {MQTT_BROKER}:{MQTT_PORT} refused connection")
+
+
+def handle_message(battery: BatteryLogic, payload):
+    ''' Passes a message from the charger to the state machine of the car '''
+    try:
+        msg = messages.decode(payload)
+    except messages.MessageError as e:
+        logger.warning(f"Ignored invalid message: {e}")
+        return
+
+    if type(msg) is messages.StartCarCharging:
+        battery.charger_id = msg.charger_id
+        battery.stm.send("start_charging")
+        
+    elif type(msg) is messages.StopCharging:
+        battery.stm.send("finish_charging")
+
+
+def get_driver_load(stm_driver: stmpy.Driver):
+    '''
+    The number of queued events and active timers of a driver, or None for both if they can not be read.
+    stmpy has no public API for these, so this is the only place that reads its internals. 
+    Queue.qsize() and len() are safe to call while the driver thread runs.
+    '''
+    try:
+        return stm_driver._event_queue.qsize(), len(stm_driver._timer_queue)
+    except (AttributeError, TypeError):
+        return None, None
+
+
+'''
+The car fleet runs the state machines of many cars in one process, for example to load test the server.
+Instead of a MQTT client and driver per car, the fleet has one MQTT client subscribed to the topics of all cars,
+and the state machines are spread over a number of drivers (shards), each running in its own thread.
+A car always belongs to the same shard, given by its id, so the events of a car are handled in order.
+Larger fleets can be split over several processes, each running a fleet with its own cars.
+'''
+class CarFleet:
+    def __init__(self, car_ids, shards=4, use_engine=True, engine_settings=None):
+        ''' engine_settings are passed to the ChargeEngine, e.g. {"capacity": 60, "cv_start": 70}, see engine.py for the defaults. '''
+        self.cars = {} # topic -> BatteryLogic
+        self.engine_cars = [] # engine index -> BatteryLogic
+        self.engine = ChargeEngine(self.on_engine_update, **(engine_settings or {})) if use_engine else None
+        self.shard_sizes = [0] * max(shards, 1)
+        self.dispatcher = Dispatcher(self.dispatch, logger)
+
+        # drivers
+        self.stm_drivers = [stmpy.Driver() for _ in self.shard_sizes]
+        for stm_driver in self.stm_drivers:
+            stm_driver.start(keep_active=True)
+
+        # mqtt definitions, the client is shared by the state machines of all cars
+        self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+        self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_message = self.on_message
+
+        for car_id in car_ids:
+            self.add_car(car_id)
 
-        command = msg.get("command")
+        if self.engine is not None:
+            self.engine.start()
+        self.dispatcher.start()
+
+        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
+        self.mqtt_client.loop_start()
+
+
+    def get_shard(self, car_id):
+        ''' The shard of a car. Uses crc32 since hash() of a string differs between processes. '''
+        return zlib.crc32(car_id.encode()) % len(self.stm_drivers)
+
+
+    def add_car(self, car_id):
+        battery = BatteryLogic(car_id, self, self.engine)
+        if self.engine is not None:
+            self.engine_cars.append(battery)
+        shard = self.get_shard(car_id)
+        self.cars[f"{CAR_TOPIC}/{car_id}"] = battery
+        self.shard_sizes[shard] += 1
+        self.stm_drivers[shard].add_machine(battery.stm)
+        return battery
 
-        if command == "start_charging":
-            charger_id = msg.get("charger_id")
-            self.battery.charger_id = charger_id
-            self.battery.stm.send("start_charging")
-            
-        elif command == "stop_charging":
-            self.battery.stm.send("finish_charging")
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.debug(f"Client connected to broker {MQTT_BROKER}:{MQTT_PORT}.")
+            # Subscribed on every connect, since the subscription is lost if the client reconnects
+            self.mqtt_client.subscribe(f"{CAR_TOPIC}/+")
         else:
             logger.debug(f"Broker {MQTT_BROKER}:{MQTT_PORT} refused connection")
+
+
+    def on_message(self, client, userdata, msg):
+        battery = self.cars.get(msg.topic)
+        if battery is None: # a car that is not in this fleet
+            return
+        logger.debug(f"MQTT Client recieved a message in topic '{msg.topic}': {msg.payload}")
+        self.dispatcher.put(msg.topic, msg.payload)
+
+
+    def dispatch(self, topic, payload):
+        handle_message(self.cars[topic], payload)
+
+
+    def on_engine_update(self, indices, percentages):
+        ''' Sends a battery update from each car whose percentage changed in the last tick of the engine '''
+        for index, percentage in zip(indices.tolist(), percentages.tolist()):
+            battery = self.engine_cars[index]
+            battery.percentage = percentage
+            battery.send_battery_update()
+
+
+    def shard_stats(self):
+        ''' The number of cars, queued events and active timers of each shard. A growing queue means the shard can not keep up. '''
+        stats = []
+        for shard, stm_driver in enumerate(self.stm_drivers):
+            queue_depth, timers = get_driver_load(stm_driver)
+            stats.append({"shard": shard, "cars": self.shard_sizes[shard], "queue_depth": queue_depth, "timers": timers})
+        return stats
+
+
+    def stop(self):
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+        self.dispatcher.stop()
+        if self.engine is not None:
+            self.engine.stop()
+        for stm_driver in self.stm_drivers:
+            stm_driver.stop()
@@ -0,0 +1,133 @@
+import threading
+import time
+import numpy as np
+
+# Battery and charging curve defaults, each can be set per engine (see CarFleet and run.py)
+BATTERY_CAPACITY = 75 # kWh
+MAX_CHARGING_POWER = 150 # kW
+CV_START = 80 # percent, the battery is charged with constant power (CC) until this level
+CV_MIN_POWER = 0.05 # the charging power above CV_START falls linearly towards this fraction of MAX_CHARGING_POWER at 100 percent (CV)
+
+# Simulation settings
+TICK = 0.5 # seconds between updates
+TIME_SCALE = 60 # simulated seconds per real second
+
+'''
+This file contains the charge engine, which simulates the batteries of many charging cars at once.
+The state of charge of all cars is kept in arrays, so every tick is a few array operations, whatever the number of cars.
+After each tick the engine reports the cars whose whole percentage changed, which then send a battery update.
+'''
+
+
+class ChargeEngine:
+    def __init__(
+            self, on_update, tick=TICK, time_scale=TIME_SCALE, cv_start=CV_START, cv_min_power=CV_MIN_POWER, 
+            capacity=BATTERY_CAPACITY, max_power=MAX_CHARGING_POWER, size=1024,
+        ):
+        ''' 
+        on_update(indices, percentages) is called from the engine thread after each tick with the cars that changed.
+        capacity and max_power are used for the batteries added without their own.
+        '''
+        if not 0 <= cv_start < 100:
+            raise ValueError(f"cv_start must be at least 0 and below 100, not {cv_start}")
+        if not 0 < cv_min_power <= 1:
+            raise ValueError(f"cv_min_power must be above 0 and at most 1, not {cv_min_power}")
+        if capacity <= 0 or max_power <= 0:
+            raise ValueError(f"capacity and max_power must be above 0, not {capacity} and {max_power}")
+        self.on_update = on_update
+        self.tick = tick
+        self.time_scale = time_scale
+        self.cv_start = cv_start
+        self.cv_min_power = cv_min_power
+        self.battery_capacity = capacity
+        self.max_charging_power = max_power
+        self.lock = threading.Lock()
+        self.count = 0
+
+        self.soc = np.zeros(size) # percent
+        self.capacity = np.zeros(size) # kWh
+        self.max_power = np.zeros(size) # kW
+        self.charging = np.zeros(size, dtype=bool)
+
+        self.running = False
+        self.thread = None
+
+
+    def add(self, percentage, capacity=None, max_power=None):
+        ''' Adds a battery and returns its index in the engine. '''
+        capacity = self.battery_capacity if capacity is None else capacity
+        max_power = self.max_charging_power if max_power is None else max_power
+        with self.lock:
+            if self.count == len(self.soc):
+                self._grow()
+            index = self.count
+            self.count += 1
+            self.soc[index] = percentage
+            self.capacity[index] = capacity
+            self.max_power[index] = max_power
+        return index
+
+
+    def _grow(self):
+        size = len(self.soc) * 2
+        for name in ("soc", "capacity", "max_power", "charging"):
+            array = getattr(self, name)
+            grown = np.zeros(size, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+
+    def start_charging(self, index, percentage):
+        with self.lock:
+            self.soc[index] = percentage
+            self.charging[index] = True
+
+
+    def stop_charging(self, index):
+        ''' Returns the whole percentage of the battery. '''
+        with self.lock:
+            self.charging[index] = False
+            return int(self.soc[index])
+
+
+    def get_power(self, soc):
+        ''' The charging power in kW at each state of charge: constant up to cv_start, then falling linearly. '''
+        taper = (100 - soc) / (100 - self.cv_start) * (1 - self.cv_min_power) + self.cv_min_power
+        return self.max_power[:len(soc)] * np.clip(taper, self.cv_min_power, 1)
+
+
+    def step(self, seconds):
+        ''' Charges all charging batteries for the given simulated time. Returns the indices and percentages of the cars whose whole percentage changed. '''
+        with self.lock:
+            n = self.count
+            soc = self.soc[:n]
+            charging = self.charging[:n]
+            before = soc.astype(np.int64)
+            energy = self.get_power(soc) * (seconds / 3600) # kWh
+            np.minimum(soc + np.where(charging, energy / self.capacity[:n] * 100, 0), 100, out=soc)
+            after = soc.astype(np.int64)
+            changed = np.flatnonzero((after != before) & charging)
+            return changed, after[changed]
+
+
+    def _loop(self):
+        last = time.monotonic()
+        while self.running:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            indices, percentages = self.step((now - last) * self.time_scale)
+            last = now
+            if len(indices):
+                self.on_update(indices, percentages)
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name="charge-engine", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
@@ -1,7 +1,14 @@
-from car import BatteryComponent
+from car import BatteryComponent, CarFleet
 import sys
+import time
 import logging
 
+FLEET_CAR_ID_PREFIX = "car"
+FLEET_SHARDS = 4
+FLEET_STATS_INTERVAL = 10 # seconds
+# Settings of the charge engine that can be given as <name>=<value> after the fleet args, see engine.py
+FLEET_ENGINE_SETTINGS = ("capacity", "max_power", "cv_start", "cv_min_power", "tick", "time_scale")
+
 
 def logger_init(level):
     logger = logging.getLogger("car_logger")
@@ -23,16 +30,61 @@ def get_car_id_arg():
 
     return car_id
 
+def get_fleet_args():
+    ''' 
+    The car ids, number of shards and engine settings of: 
+    python run.py --fleet <first_car_number> <last_car_number> [<shards>] [<setting>=<value> ...]
+    e.g. python run.py --fleet 1 1000 4 capacity=60 max_power=50 cv_start=70
+    '''
+    args = sys.argv
+    if len(args) < 4:
+        raise ValueError(
+            "The cars are not specified. Run the program with: "
+            "python run.py --fleet <first_car_number> <last_car_number> [<shards>] [<setting>=<value> ...]"
+        )
+
+    car_ids = [f"{FLEET_CAR_ID_PREFIX}{number}" for number in range(int(args[2]), int(args[3]) + 1)]
+    rest = args[4:]
+    shards = int(rest.pop(0)) if rest and rest[0].isdigit() else FLEET_SHARDS
+
+    engine_settings = {}
+    for arg in rest:
+        name, _, value = arg.partition("=")
+        if name not in FLEET_ENGINE_SETTINGS or not value:
+            raise ValueError(f"Invalid engine setting '{arg}', expected <setting>=<value> with one of: {', '.join(FLEET_ENGINE_SETTINGS)}")
+        engine_settings[name] = float(value)
+
+    return car_ids, shards, engine_settings
+
 def run():
-    ''' Starts car battery component from args '''
+    ''' Starts car battery component from args, or a car fleet with --fleet '''
+    if len(sys.argv) > 1 and sys.argv[1] == "--fleet":
+        run_fleet()
+        return
+
     logger_init(logging.DEBUG)
     
     car_id = get_car_id_arg()
     BatteryComponent(car_id)
 
+def run_fleet():
+    ''' Starts a car fleet from args, and prints the load of its shards '''
+    logger_init(logging.WARNING) # Logging every battery update of every car would slow down the fleet
+
+    car_ids, shards, engine_settings = get_fleet_args()
+    fleet = CarFleet(car_ids, shards, engine_settings=engine_settings)
+    while True:
+        time.sleep(FLEET_STATS_INTERVAL)
+        for stats in fleet.shard_stats():
+            print("Shard {shard}: {cars} cars, {queue_depth} queued events, {timers} timers".format(**stats))
+        print("Dispatcher: {depth} queued messages (max {max_depth}), {dropped} dropped, {avg_wait_ms:.1f} ms average wait".format(**fleet.dispatcher.stats()))
+
 def run_from_python(car_id):
     BatteryComponent(car_id)
 
+def run_fleet_from_python(car_ids, shards=FLEET_SHARDS, **engine_settings):
+    return CarFleet(car_ids, shards, engine_settings=engine_settings)
+
 
 if __name__ == "__main__":
     run()
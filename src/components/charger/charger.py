@@ -1,14 +1,23 @@
 import threading
-import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 import paho.mqtt.client as mqtt
 import stmpy
 #import audio
 import requests
-from sense_hat import SenseHat
 import time
 import sys
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")) # see common/messages.py
+import messages
+from dispatch import Dispatcher
+
+try:
+    from sense_hat import SenseHat
+except ImportError as e: # Only needed for the display, which the charger host does not use
+    SenseHat = None
+    sense_hat_error = e
 
 # Configure the MQTT settings 
 MQTT_BROKER = "test.mosquitto.org"
@@ -19,6 +28,10 @@ CAR_TOPIC = "ttm4115/g11/cars"
 
 # Server settings
 SERVER_URL = "http://localhost:8000"
+SERVER_TIMEOUT = 5 # seconds
+SERVER_RETRY_INTERVAL = 10000 # ms between attempts to reach the server after a connection error
+HOST_SERVER_REQUEST_THREADS = 8
+HOST_HEARTBEAT_INTERVAL = 5000 # ms between the requests of the heartbeat shared by the chargers of a host
 
 logger = logging.getLogger("charger_logger")
 
@@ -32,7 +45,8 @@ threading functionality in sensehat.py.
 
 # State machine logic for the Charger
 class ChargerLogic:
-    def __init__(self, charger_id, component):
+    def __init__(self, charger_id, component, interface=None, heartbeat=True):
+        ''' Without heartbeat, the charger does not say hello to the server, e.g. when the charger host does it for all its chargers. '''
         self.exception = None
         self.exception_type = None
         self.component : ChargerComponent = component
@@ -44,18 +58,24 @@ class ChargerLogic:
             {"source": "initial", "target": "idle", "effect": "stm_init"},
             {"trigger": "nozzle_connected", "source": "idle", "target": "connected", "effect": "on_nozzle_connected"},
             {"trigger": "nozzle_disconnected", "source": "connected", "target": "idle", "effect": "on_nozzle_disconnected"},
-            {"trigger": "start_charging", "source": "connected", "target": "charging", "effect": "stop_timer('charging_timer');on_start_charging"},
+            # The start_charging events carry the StartCharging message
+            {"trigger": "start_charging", "source": "connected", "target": "charging", "effect": "on_start_charging(*)"},
             {"trigger": "battery_charged", "source": "charging", "target": "connected","effect": "on_battery_charged"},
             {"trigger": "charging_timer",  "source": "charging", "target": "connected", "effect": "on_battery_charged"},
             {"trigger": "battery_update", "source": "charging", "target": "charging", "effect": "on_battery_update"},
             {"trigger": "nozzle_disconnected", "source": "charging", "target": "idle", "effect": "on_nozzle_force_disconnected"},
-            {"trigger": "start_charging", "source": "idle", "target": "idle", "effect": "on_start_charging_attempt"},
+            {"trigger": "start_charging", "source": "idle", "target": "idle", "effect": "on_start_charging_attempt(*)"},
+            {"trigger": "start_charging_expired", "source": "idle", "target": "idle", "effect": "on_start_charging_expired(*)"},
+            {"trigger": "start_charging_expired", "source": "connected", "target": "connected", "effect": "on_start_charging_expired(*)"},
             # Error transitions
             {"trigger": "ct1", "source": "idle", "target": "idle", "effect": "hello_server"},
             {"trigger": "ct2", "source": "connected", "target": "connected", "effect": "hello_server"},
             {"trigger": "error", "source": "idle", "target": "error","effect": "on_error_occur"},
             {"trigger": "error", "source": "charging", "target": "error","effect": "on_error_occur"},
             {"trigger": "error", "source": "connected", "target": "error", "effect": "on_error_occur"},
+            {"trigger": "error_retry", "source": "error", "target": "error", "effect": "on_error_retry"},
+            {"trigger": "server_reconnected", "source": "error", "target": "error", "effect": "stop_timer('error_retry');start_timer('resolved', 3000)"},
+            {"trigger": "error", "source": "error", "target": "error"}, # e.g. a failed retry, which is retried by the error_retry timer
             {"trigger": "resolved", "source": "error", "target": "idle", "effect": "on_error_resolved"},
             {"trigger": "hw_failure", "source": "error", "target": None, "effect": "on_hardware_failure"}
         ]
@@ -63,18 +83,24 @@ class ChargerLogic:
         states = [
             {"name": "idle", "entry": "start_timer('ct1', 5000)"},
             {"name": "connected", "entry": "start_timer('ct2', 1000)"},
-        ]
+        ] if heartbeat else []
 
         self.stm = stmpy.Machine(name=f"{self.charger_id}", transitions=transitions, states=states, obj=self)
 
-        # Set the function 'handle_exception' as the global exception handler
-        sys.excepthook = self.handle_exception
+        if interface is None:
+            # Set the function 'handle_exception' as the global exception handler
+            sys.excepthook = self.handle_exception
 
-        self.interface = ChargerInterface("init", self.stm)
-        self.interface.start()
+            self.interface = ChargerInterface("init", self.stm)
+            self.interface.start()
+        else:
+            # Hosted together with other chargers, which share the process
+            self.interface = interface
+            self.interface.stm = self.stm
 
         # other variables
         self.car_id = None
+        self.command_id = None # of the StartCharging message of the current session, reported back to the server
         self.battery_target = None
         self.current_car_battery = None
         self.max_charging_time = 60 * 30 * 1000
@@ -111,29 +137,42 @@ class ChargerLogic:
         logger.warn("Charger moved from state charging -> idle. The charger was removed during charging.")
         self.interface.state = "available"
         self._stop_car_stm_charging()
+        self._deactivate_charger_in_server(self.command_id)
         self._reset_attributes()
-        self._deactivate_charger_in_server()
         
 
 
-    def on_start_charging(self):
+    def on_start_charging(self, command: messages.StartCharging):
+        self.car_id = command.car_id
+        self.command_id = command.command_id
+        self.battery_target = command.battery_target
+        self.max_charging_time = command.max_charging_time * 1000
         self.interface.battery_cap = self.battery_target
 
         logger.info(f"Charging started for car {self.car_id} with battery target {self.battery_target}%.")
         logger.info(f"The maximum time for charging is {self.max_charging_time/1000}s")
         
-        self.stm.start_timer("charging_timer", self.max_charging_time)
+        self.stm.start_timer("charging_timer", self.max_charging_time) # restarts a timer left from the previous session
         self._start_car_stm_charging()
 
         #audio.play_charging_started_sound()
 
 
-    def on_start_charging_attempt(self):
+    def on_start_charging_attempt(self, command: messages.StartCharging):
         '''Triggered when car tries to start charging without being plugged in '''
         # when receiving start_charging, the server will have made the charger unavailable
         # this method therefor has to make the charger available again
         logger.info("Someone attempted to start charging while in state idle (not connected)")
-        self._deactivate_charger_in_server()
+        self._deactivate_charger_in_server(command.command_id)
+
+
+    def on_start_charging_expired(self, command: messages.StartCharging):
+        ''' 
+        Triggered when a start command arrives after it expired, e.g. after the server lost its connection to the broker.
+        Unless the server already gave up on the command, it still has the charger activated, so it is made available again.
+        '''
+        logger.warning(f"Ignored expired start command for car {command.car_id}.")
+        self._deactivate_charger_in_server(command.command_id)
 
 
     def on_battery_charged(self):
@@ -142,7 +181,7 @@ class ChargerLogic:
         self.interface.state = "battery charged"
 
         self._stop_car_stm_charging()
-        self._deactivate_charger_in_server()
+        self._deactivate_charger_in_server(self.command_id)
         self._reset_attributes()
         #audio.play_charging_completed_sound()
         
@@ -155,33 +194,32 @@ class ChargerLogic:
        
         # TODO: Resolve error code here
 
-        if exception_type == requests.exceptions.ConnectionError:
-            attempt = 0
-            while True:
-                try:
-                    attempt += 1
-                    url = f"{SERVER_URL}/chargers/{self.charger_id}/deactivate/"
-                    logger.debug(f"(Attempt {attempt}) Trying to reconnect to: [{url}]...")
-                    requests.post(url=url)
-                    break
-                except Exception as e:
-                    time.sleep(10)
-
-        time.sleep(3)
-        self.stm.send("resolved")
+        # The driver may be shared with other chargers (see ChargerHost), so the retries and the wait 
+        # are done with timers instead of sleeping
+        if exception_type is not None and issubclass(exception_type, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            self.error_attempt = 0
+            self.on_error_retry()
+        else:
+            self.stm.start_timer("resolved", 3000)
+
+
+    def on_error_retry(self):
+        ''' Tries to reach the server, until it succeeds. '''
+        self.error_attempt += 1
+        url = f"{SERVER_URL}/chargers/{self.charger_id}/deactivate/"
+        logger.debug(f"(Attempt {self.error_attempt}) Trying to reconnect to: [{url}]...")
+        self.stm.start_timer("error_retry", SERVER_RETRY_INTERVAL)
+        self._send_to_server("POST", f"/chargers/{self.charger_id}/deactivate/", on_success="server_reconnected")
     
 
     def hello_server(self):
-        try:
-            response = requests.get(f"{SERVER_URL}/hello")
-            logger.debug(f"Received response from server.")
-        except Exception as e:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            self.handle_exception(exc_type, e, exc_traceback)
+        self._send_to_server("GET", "/hello")
 
 
     def on_error_resolved(self):
         self.interface.state = "available"
+        # The state machine is back in idle, where the nozzle is disconnected
+        self.interface.reset_nozzle()
         logger.info("Error resolved. Charger is now available.")
 
 
@@ -200,36 +238,47 @@ class ChargerLogic:
         
 
     
-    def _deactivate_charger_in_server(self):
-        try:
-            url = f"{SERVER_URL}/chargers/{self.charger_id}/deactivate/"
-            requests.post(url=url)
-        except Exception as e:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            self.handle_exception(exc_type, e, exc_traceback)
+    def _deactivate_charger_in_server(self, command_id=None):
+        ''' With the id of a start command, the server ignores the request if the charger was activated again since that command. '''
+        query = f"?command_id={command_id}" if command_id else ""
+        self._send_to_server("POST", f"/chargers/{self.charger_id}/deactivate/{query}")
+
+
+    def _send_to_server(self, method, path, on_success=None):
+        '''
+        Sends the request from the server request thread(s) of the component, so the driver is never blocked by the server. 
+        A failed request sends "error" to the state machine, and a successful one sends the on_success event, if given.
+        '''
+        def send():
+            try:
+                requests.request(method, f"{SERVER_URL}{path}", timeout=SERVER_TIMEOUT)
+                logger.debug(f"Received response from server.")
+            except Exception as e:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self.handle_exception(exc_type, e, exc_traceback)
+                return
+            if on_success is not None:
+                self.stm.send(on_success)
+        self.component.server_requests.submit(send)
 
         
     def _stop_car_stm_charging(self):
         ''' Sends stop charging signal to car '''
         topic = f"{CAR_TOPIC}/{self.car_id}"
-        payload = {"command": "stop_charging"}
-        payload = json.dumps(payload)
+        payload = messages.encode(messages.StopCharging())
         self.component.mqtt_client.publish(topic, payload)
     
 
     def _start_car_stm_charging(self):
         ''' Sends start charging signal to car '''
         topic = f"{CAR_TOPIC}/{self.car_id}"
-        payload = {
-            "command": "start_charging",
-            "charger_id": self.charger_id,
-        }
-        payload = json.dumps(payload)
+        payload = messages.encode(messages.StartCarCharging(self.charger_id))
         self.component.mqtt_client.publish(topic, payload)
     
 
     def _reset_attributes(self):
         self.car_id = None
+        self.command_id = None
         self.battery_target = 0
         self.current_car_battery = 0
    
@@ -240,6 +289,11 @@ class ChargerLogic:
 # The MQTT Client for the Charger
 class ChargerComponent:
     def __init__(self, charger_id):
+        # Messages are handled by the dispatcher thread, started when the state machine is ready
+        self.dispatcher = Dispatcher(self.dispatch, logger)
+        # Requests to the server are sent from this thread, in order
+        self.server_requests = ThreadPoolExecutor(max_workers=1)
+
         # mqtt definitions
         self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
         self.mqtt_client.on_connect = self.on_connect
@@ -255,6 +309,7 @@ class ChargerComponent:
         self.stm_driver = stmpy.Driver()
         self.stm_driver.start(keep_active=True)
         self.stm_driver.add_machine(self.charger.stm)
+        self.dispatcher.start()
 
 
     # Initial connected message
@@ -267,28 +322,132 @@ class ChargerComponent:
     # Battery percentage
     def on_message(self, client, userdata, msg):
         logger.debug(f"MQTT Client recieved a message in topic '{msg.topic}': {msg.payload}")
-        
-        msg = json.loads(msg.payload)  # now a dict
-        command = msg.get("command")
+        self.dispatcher.put(msg.topic, msg.payload)
 
-        if command == "start_charging":
-            battery_target = msg.get("battery_target")
-            car_id = msg.get("car_id")
-            max_charging_time = msg.get("max_charging_time")
-            
-            self.charger.battery_target = battery_target
-            self.charger.car_id = car_id
-            self.charger.max_charging_time = max_charging_time * 1000
-            
-            self.charger.stm.send("start_charging")
-        
-        elif command == "stop_charging":
-            self.charger.stm.send("battery_charged")
-        
-        elif command == "battery_update":
-            percentage = msg.get("percentage")
-            self.charger.current_car_battery = percentage
-            self.charger.stm.send("battery_update")
+
+    def dispatch(self, topic, payload):
+        handle_message(self.charger, payload)
+
+
+def handle_message(charger: ChargerLogic, payload):
+    ''' Passes a message from the server or the car to the state machine of the charger '''
+    try:
+        msg = messages.decode(payload)
+    except messages.MessageError as e:
+        logger.warning(f"Ignored invalid message: {e}")
+        return
+
+    if type(msg) is messages.StartCharging:
+        # Passed with the event, so a command arriving while charging does not overwrite the current session
+        charger.stm.send("start_charging_expired" if msg.is_expired() else "start_charging", args=[msg])
+    
+    elif type(msg) is messages.StopCharging:
+        charger.stm.send("battery_charged")
+    
+    elif type(msg) is messages.BatteryUpdate:
+        charger.current_car_battery = msg.percentage
+        charger.stm.send("battery_update")
+
+    elif type(msg) is messages.Nozzle:
+        charger.interface.set_nozzle(msg.connected)
+
+
+'''
+The charger host runs the state machines of many chargers in one process, for example to simulate a whole depot.
+Instead of a MQTT client, driver and display per charger, the host has one MQTT client subscribed to the topics
+of all chargers, and one driver running all the state machines. Messages are routed to the state machine of 
+a charger by their topic. The chargers also share one heartbeat to the server, instead of saying hello every second each.
+'''
+class ChargerHost:
+    def __init__(self, charger_ids, auto_connect=True):
+        ''' 
+        Hosted chargers have no joystick, so their nozzle is set with Nozzle messages on their topic.
+        With auto_connect, the nozzle of every charger is connected when it starts, so the chargers can start charging right away.
+        '''
+        self.auto_connect = auto_connect
+        self.server_reachable = True
+        self.stopped = threading.Event()
+        self.chargers = {} # topic -> ChargerLogic
+        self.dispatcher = Dispatcher(self.dispatch, logger)
+        # Shared by the chargers, so a slow server does not block the driver, and through it every charger
+        self.server_requests = ThreadPoolExecutor(max_workers=HOST_SERVER_REQUEST_THREADS)
+
+        # driver
+        self.stm_driver = stmpy.Driver()
+        self.stm_driver.start(keep_active=True)
+
+        for charger_id in charger_ids:
+            self.add_charger(charger_id)
+        self.dispatcher.start()
+
+        # mqtt definitions
+        self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+        self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
+        self.mqtt_client.loop_start()
+
+        self.heartbeat = threading.Thread(target=self._heartbeat, name="charger-host-heartbeat", daemon=True)
+        self.heartbeat.start()
+
+
+    def add_charger(self, charger_id):
+        charger = ChargerLogic(charger_id, self, interface=HostedInterface(self.auto_connect), heartbeat=False)
+        self.chargers[f"{CHARGER_TOPIC}/{charger_id}"] = charger
+        self.stm_driver.add_machine(charger.stm)
+        if self.auto_connect:
+            charger.interface.set_nozzle(True)
+        return charger
+
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.debug(f"Client connected to broker {MQTT_BROKER}:{MQTT_PORT}.")
+            # Subscribed on every connect, since the subscription is lost if the client reconnects
+            self.mqtt_client.subscribe(f"{CHARGER_TOPIC}/+")
+        else:
+            logger.debug(f"Broker {MQTT_BROKER}:{MQTT_PORT} refused connection")
+
+
+    def on_message(self, client, userdata, msg):
+        charger = self.chargers.get(msg.topic)
+        if charger is None: # a charger that is not hosted by this process
+            return
+        logger.debug(f"MQTT Client recieved a message in topic '{msg.topic}': {msg.payload}")
+        self.dispatcher.put(msg.topic, msg.payload)
+
+
+    def dispatch(self, topic, payload):
+        handle_message(self.chargers[topic], payload)
+
+
+    def _heartbeat(self):
+        ''' 
+        Says hello to the server for all chargers, and logs when it becomes unreachable or reachable again. 
+        A hosted charger goes to the error state when one of its own requests fails.
+        '''
+        while not self.stopped.wait(HOST_HEARTBEAT_INTERVAL / 1000):
+            try:
+                requests.get(f"{SERVER_URL}/hello", timeout=SERVER_TIMEOUT)
+                reachable = True
+            except Exception as e:
+                reachable = False
+                error = e
+            if reachable != self.server_reachable:
+                if reachable:
+                    logger.info("Server is reachable again.")
+                else:
+                    logger.error(f"Server is unreachable: {error}")
+            self.server_reachable = reachable
+
+
+    def stop(self):
+        self.stopped.set()
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+        self.dispatcher.stop()
+        self.stm_driver.stop()
+        self.server_requests.shutdown(wait=False, cancel_futures=True)
 
 
 
@@ -310,9 +469,39 @@ NEGATIVE_SIGN_END = 58
 OVERFLOW_PIXEL = 63
 
 
+class HostedInterface:
+    ''' Keeps the display state of a hosted charger, which has no SenseHat. '''
+    def __init__(self, auto_connect=False):
+        self.state = "init"
+        self.battery_lvl = 0
+        self.battery_cap = 0
+        self.connected = False
+        self.auto_connect = auto_connect
+        self.stm = None # set by ChargerLogic
+
+    def set_nozzle(self, connected):
+        ''' Connects or disconnects the nozzle, like the joystick of ChargerInterface '''
+        if connected != self.connected:
+            self.connected = connected
+            self.stm.send("nozzle_connected" if connected else "nozzle_disconnected")
+
+    def reset_nozzle(self):
+        self.connected = False
+        if self.auto_connect:
+            self.set_nozzle(True)
+
+    def start(self):
+        return
+
+    def stop(self):
+        return
+
+
 class ChargerInterface:
     def __init__(self, state, stm):
         logger.debug("Charger interface: initializing.")
+        if SenseHat is None:
+            raise ImportError(f"The charger display needs the sense_hat package, which could not be imported: {sense_hat_error}")
         self.sense = SenseHat()
         self.running = False
         
@@ -469,15 +658,19 @@ class ChargerInterface:
         if event.action != 'pressed':
             return
     
-        # When nozzle is connected
-        if (self.connected): 
-            self.stm.send("nozzle_disconnected")
-            self.connected = False
-            
-        # When nozzle is disconnected.
-        else:
-            self.stm.send("nozzle_connected")
-            self.connected = True
+        # Disconnects a connected nozzle, and connects a disconnected one
+        self.set_nozzle(not self.connected)
+
+    # Also called for Nozzle messages, to connect or disconnect the nozzle remotely
+    def set_nozzle(self, connected):
+        if connected == self.connected:
+            return
+        self.stm.send("nozzle_connected" if connected else "nozzle_disconnected")
+        self.connected = connected
+
+    # Called when the state machine returns to idle by itself, so the next press connects the nozzle
+    def reset_nozzle(self):
+        self.connected = False
 
     
     
\ No newline at end of file
@@ -1,4 +1,4 @@
-from charger import ChargerComponent
+from charger import ChargerComponent, ChargerHost
 import sys
 import logging
 
@@ -12,25 +12,38 @@ def logger_init(level):
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-def get_charger_id_arg():
+def get_charger_ids_arg():
+    ''' The charger ids from args, where each arg is an id or a range of ids like 1-200 '''
     args = sys.argv
     if len(args) < 2:
-        raise ValueError("charger_id is not specified. Run the program with: python run.py <charger_id>")
+        raise ValueError("charger_id is not specified. Run the program with: python run.py <charger_id> [<charger_id> ...]")
     
-    charger_id = int(args[1])
+    charger_ids = []
+    for arg in args[1:]:
+        if "-" in arg:
+            first, last = arg.split("-")
+            charger_ids.extend(range(int(first), int(last) + 1))
+        else:
+            charger_ids.append(int(arg))
 
-    return charger_id
+    return charger_ids
 
 def run():
-    ''' Starts charger component from args '''
+    ''' Starts charger component from args, or a charger host if several chargers are given '''
     logger_init(logging.DEBUG)
 
-    charger_id = get_charger_id_arg()
-    ChargerComponent(charger_id)
+    charger_ids = get_charger_ids_arg()
+    if len(charger_ids) == 1:
+        ChargerComponent(charger_ids[0])
+    else:
+        ChargerHost(charger_ids)
 
 def run_from_python(charger_id):
     ChargerComponent(charger_id)
 
+def run_host_from_python(charger_ids):
+    return ChargerHost(charger_ids)
+
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,61 @@
+import sys
+import time
+
+import messages
+
+"""
+This file benchmarks the JSON and binary encodings of messages.py.
+One round is the traffic of a fleet of cars for one tick: every car sends a battery update to its charger,
+and a tenth of the chargers start or stop charging a car. Every message is encoded by the sender and decoded by the receiver.
+
+Run with: python benchmark.py [cars] [rounds]
+"""
+
+
+def get_fleet_messages(cars: int):
+    fleet_messages = [messages.BatteryUpdate(car % 100) for car in range(cars)]
+    for car in range(0, cars, 10):
+        fleet_messages.append(messages.StartCharging(f"car{car}", 80, 1800))
+        fleet_messages.append(messages.StartCarCharging(car))
+        fleet_messages.append(messages.StopCharging())
+    return fleet_messages
+
+
+def run_benchmark(encoding: str, fleet_messages: list, rounds: int):
+    encode_time, decode_time, payload_bytes = 0, 0, 0
+    for _ in range(rounds):
+        t = time.perf_counter()
+        payloads = [messages.encode(message, encoding) for message in fleet_messages]
+        encode_time += time.perf_counter() - t
+
+        # The MQTT client sends str payloads as UTF-8, and receivers always get bytes
+        payloads = [payload.encode() if isinstance(payload, str) else payload for payload in payloads]
+        payload_bytes += sum(len(payload) for payload in payloads)
+
+        t = time.perf_counter()
+        decoded = [messages.decode(payload) for payload in payloads]
+        decode_time += time.perf_counter() - t
+
+    assert decoded == fleet_messages
+    count = len(fleet_messages) * rounds
+    return {
+        "encode us/msg": encode_time / count * 1e6,
+        "decode us/msg": decode_time / count * 1e6,
+        "bytes/msg": payload_bytes / count,
+        "KB/round": payload_bytes / rounds / 1000,
+    }
+
+
+def run():
+    cars = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    fleet_messages = get_fleet_messages(cars)
+    print(f"{cars} cars x {rounds} rounds ({len(fleet_messages)} messages per round)")
+
+    for encoding in ("json", "binary"):
+        result = run_benchmark(encoding, fleet_messages, rounds)
+        print(f"{encoding:8}" + "".join(f"  {key}: {value:8.2f}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    run()
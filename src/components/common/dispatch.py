@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from collections import deque
+
+'''
+This file contains the dispatcher, which moves the handling of MQTT messages off the network thread of the MQTT client.
+on_message only puts the message in a bounded queue, and a worker thread decodes it and passes it to the state machines.
+A slow handler then delays the following messages, but not the keepalives and the reading of the socket.
+
+When the queue is full, the overflow policy decides what happens to a new message:
+* drop_oldest: the oldest queued message is dropped, so the latest state is kept (default)
+* drop_newest: the new message is dropped
+* block: on_message waits for room in the queue, so no message is lost, but the network thread is stalled
+'''
+
+QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", 10000))
+OVERFLOW = os.getenv("DISPATCH_OVERFLOW", "drop_oldest")
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+
+class Dispatcher:
+    def __init__(self, handler, logger, max_size: int = QUEUE_SIZE, overflow: str = OVERFLOW):
+        ''' handler(topic, payload) is called from the worker thread for each message, in the order they were received. '''
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}, must be one of {', '.join(OVERFLOW_POLICIES)}")
+        self.handler = handler
+        self.logger = logger
+        self.max_size = max(max_size, 1)
+        self.overflow = overflow
+        self.queue = deque() # (topic, payload, time received)
+        self.condition = threading.Condition()
+        self.running = False
+        self.worker = None
+
+        # Metrics, see stats()
+        self.received = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self.total_handling = 0
+
+
+    def put(self, topic, payload):
+        ''' Queues a message. Called from on_message, on the network thread. Returns False if the message was dropped. '''
+        with self.condition:
+            self.received += 1
+            if len(self.queue) >= self.max_size:
+                if self.overflow == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.overflow == "drop_oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.queue) >= self.max_size and self.running:
+                        self.condition.wait()
+            self.queue.append((topic, payload, time.monotonic()))
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.condition.notify_all()
+        return True
+
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.queue and self.running:
+                    self.condition.wait()
+                if not self.queue: # stopped, and every queued message is handled
+                    return
+                topic, payload, received = self.queue.popleft()
+                self.condition.notify_all()
+
+            start = time.monotonic()
+            try:
+                self.handler(topic, payload)
+            except Exception as e:
+                self.errors += 1
+                self.logger.error(f"Failed to handle message in topic '{topic}': {e}")
+            end = time.monotonic()
+
+            with self.condition:
+                self.handled += 1
+                self.total_wait += start - received
+                self.max_wait = max(self.max_wait, start - received)
+                self.total_handling += end - start
+
+
+    def start(self):
+        self.running = True
+        self.worker = threading.Thread(target=self._loop, name="mqtt-dispatch", daemon=True)
+        self.worker.start()
+
+
+    def stop(self):
+        ''' Stops the worker after it has handled the queued messages. '''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+
+
+    def stats(self):
+        ''' The queue depth, message counts and latencies in milliseconds. wait is the time a message spent in the queue. '''
+        with self.condition:
+            handled = max(self.handled, 1)
+            return {
+                "depth": len(self.queue),
+                "max_depth": self.max_depth,
+                "received": self.received,
+                "handled": self.handled,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "avg_wait_ms": self.total_wait / handled * 1000,
+                "max_wait_ms": self.max_wait * 1000,
+                "avg_handling_ms": self.total_handling / handled * 1000,
+            }
@@ -0,0 +1,153 @@
+import json
+import os
+import struct
+import time
+from typing import NamedTuple
+
+'''
+This file contains the MQTT messages sent between the server, the chargers and the cars, shared by all components.
+
+A message is encoded either as JSON, or as a compact binary message: a version byte, a type byte and a fixed layout
+of the fields. decode() accepts both, telling them apart by the first byte ('{' for JSON, the version byte for binary),
+so components using different encodings can talk to each other. The encoding used for sending is set with MQTT_ENCODING.
+
+Every component runs from its own directory, with flat imports. So the modules that import messages.py or dispatch.py
+(car.py, charger.py and server/mqtt.py) add this directory to sys.path first, relative to their own file:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+'''
+
+ENCODING = os.getenv("MQTT_ENCODING", "json") # json or binary
+VERSION = 1
+
+
+class MessageError(ValueError):
+    pass
+
+
+class StartCharging(NamedTuple):
+    ''' From the server to a charger, when a charger has been activated for a car '''
+    car_id: str
+    battery_target: int
+    max_charging_time: int # seconds
+    command_id: int = 0 # reported back when the charger is deactivated, so a late report does not end a newer session
+    expires_at: float = 0 # unix time after which the charger ignores the command, 0 if it never expires
+
+    def is_expired(self):
+        return self.expires_at != 0 and time.time() > self.expires_at
+
+
+class StartCarCharging(NamedTuple):
+    ''' From a charger to a car, when charging starts '''
+    charger_id: int
+
+
+class StopCharging(NamedTuple):
+    ''' From a charger to a car, or to a charger, when charging stops '''
+
+
+class BatteryUpdate(NamedTuple):
+    ''' From a car to its charger, when the battery percentage changes '''
+    percentage: int
+
+
+class Nozzle(NamedTuple):
+    ''' To a charger without a joystick (see ChargerHost), when the nozzle is connected to or disconnected from a car '''
+    connected: bool
+
+
+# Binary encoding: type code and struct layout of the fixed fields of each message.
+# The car_id of StartCharging is variable length, and follows the fixed fields as UTF-8.
+HEADER = struct.Struct(">BB")
+LAYOUTS = {
+    StartCharging: (1, struct.Struct(">BIId")),
+    StartCarCharging: (2, struct.Struct(">I")),
+    StopCharging: (3, struct.Struct("")),
+    BatteryUpdate: (4, struct.Struct(">B")),
+    Nozzle: (5, struct.Struct(">?")),
+}
+TYPES = {code: (message_type, layout) for message_type, (code, layout) in LAYOUTS.items()}
+# Prebuilt, since they are sent very often and never change
+HEADERS = {message_type: HEADER.pack(VERSION, code) for message_type, (code, _) in LAYOUTS.items()}
+
+
+def encode_binary(message) -> bytes:
+    ''' Raises MessageError if a field does not fit its binary layout, e.g. a negative max_charging_time. '''
+    try:
+        _, layout = LAYOUTS[type(message)]
+        if type(message) is StartCharging:
+            return HEADERS[StartCharging] + layout.pack(*message[1:]) + message.car_id.encode()
+        return HEADERS[type(message)] + layout.pack(*message)
+    except KeyError:
+        raise MessageError(f"Unknown message {message}")
+    except (struct.error, UnicodeEncodeError) as e:
+        raise MessageError(f"Message {message} can not be encoded: {e}")
+
+
+def decode_binary(payload: bytes):
+    try:
+        version, code = HEADER.unpack_from(payload)
+        if version != VERSION:
+            raise MessageError(f"Unsupported message version {version}")
+        message_type, layout = TYPES[code]
+        fields = layout.unpack_from(payload, HEADER.size)
+    except (struct.error, KeyError) as e:
+        raise MessageError(f"Invalid binary message: {e}")
+    if message_type is StartCharging:
+        try:
+            car_id = payload[HEADER.size + layout.size:].decode()
+        except UnicodeDecodeError as e:
+            raise MessageError(f"Invalid binary message: {e}")
+        return StartCharging(car_id, *fields)
+    return message_type(*fields)
+
+
+# JSON encoding, compatible with the payloads used before the binary encoding
+def encode_json(message) -> str:
+    if type(message) is StartCharging:
+        payload = {"command": "start_charging", **message._asdict()}
+    elif type(message) is StartCarCharging:
+        payload = {"command": "start_charging", "charger_id": message.charger_id}
+    elif type(message) is StopCharging:
+        payload = {"command": "stop_charging"}
+    elif type(message) is BatteryUpdate:
+        payload = {"command": "battery_update", "percentage": message.percentage}
+    elif type(message) is Nozzle:
+        payload = {"command": "nozzle", "connected": message.connected}
+    else:
+        raise MessageError(f"Unknown message {message}")
+    return json.dumps(payload)
+
+
+def decode_json(payload):
+    try:
+        msg = json.loads(payload)
+        command = msg["command"]
+        if command == "start_charging" and "charger_id" in msg:
+            return StartCarCharging(msg["charger_id"])
+        if command == "start_charging":
+            return StartCharging(msg["car_id"], msg["battery_target"], msg["max_charging_time"], msg.get("command_id", 0), msg.get("expires_at", 0))
+        if command == "stop_charging":
+            return StopCharging()
+        if command == "battery_update":
+            return BatteryUpdate(msg["percentage"])
+        if command == "nozzle":
+            return Nozzle(bool(msg["connected"]))
+    except (ValueError, KeyError, TypeError) as e:
+        raise MessageError(f"Invalid JSON message: {e}")
+    raise MessageError(f"Unknown command {command}")
+
+
+def encode(message, encoding: str = None):
+    ''' Encodes the message with the given encoding, or MQTT_ENCODING '''
+    if (encoding or ENCODING) == "binary":
+        return encode_binary(message)
+    return encode_json(message)
+
+
+def decode(payload):
+    ''' Decodes a JSON or binary message. Raises MessageError if the payload is not a valid message. '''
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if payload[:1] == b"{":
+        return decode_json(payload)
+    return decode_binary(payload)
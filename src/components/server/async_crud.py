@@ -0,0 +1,185 @@
+from sqlalchemy import exists, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from datetime import datetime
+from typing import Optional
+
+import crud, models, schemas, utils
+from cache import ChargerState, car_cache, charger_cache
+
+"""
+This file contains the async versions of the methods in crud.py, used when the server runs in async database mode.
+Relationships can not be lazy loaded with async sessions, so the ones returned by the endpoints are loaded up front,
+in the same way as in crud.py.
+"""
+
+
+# Embedded reservations
+async def _load_reservations(db: AsyncSession, parents: list, foreign_key, window: schemas.ReservationWindow):
+    if parents:
+        result = await db.scalars(crud.reservations_query(foreign_key, [parent.id for parent in parents], window))
+        crud.assign_reservations(parents, result.all(), foreign_key.key)
+
+
+# Column projections
+async def get_columns(db: AsyncSession, model, id, columns: list[str]):
+    result = await db.execute(select(*crud.select_columns(model, columns)).filter(model.id == id))
+    return result.first()
+
+
+# Versions
+async def get_version(db: AsyncSession, model, id):
+    result = await db.execute(select(model.version).filter(model.id == id))
+    return result.scalar()
+
+
+# Car
+async def get_car(db: AsyncSession, car_id: str, reservations: Optional[schemas.ReservationWindow] = None):
+    result = await db.execute(select(models.Car).filter(models.Car.id == car_id))
+    db_car = result.scalars().first()
+    if db_car is not None and reservations is not None:
+        await _load_reservations(db, [db_car], models.Reservation.car_id, reservations)
+    return db_car
+
+
+async def car_exists(db: AsyncSession, car_id: str):
+    if car_cache.get(car_id):
+        return True
+    if not (await db.execute(select(exists().where(models.Car.id == car_id)))).scalar():
+        return False
+    car_cache.put(car_id, True)
+    return True
+
+
+async def create_car(db: AsyncSession, car: schemas.CarCreate):
+    db_car = models.Car(id=car.id, reservations=[])
+    db.add(db_car)
+    await db.commit()
+    car_cache.invalidate(car.id)
+    return db_car
+
+
+# Charger
+async def get_charger(db: AsyncSession, charger_id: int, reservations: Optional[schemas.ReservationWindow] = None):
+    result = await db.execute(select(models.Charger).filter(models.Charger.id == charger_id))
+    db_charger = result.scalars().first()
+    if db_charger is not None and reservations is not None:
+        await _load_reservations(db, [db_charger], models.Reservation.charger_id, reservations)
+    return db_charger
+
+
+async def get_charger_state(db: AsyncSession, charger_id: int, use_cache: bool = True):
+    if use_cache:
+        state = charger_cache.get(charger_id)
+        if state is not None:
+            return state
+    result = await db.execute(
+        select(models.Charger.id, models.Charger.is_reservable, models.Charger.is_available, models.Charger.station_id)
+        .filter(models.Charger.id == charger_id)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    state = ChargerState(*row)
+    charger_cache.put(charger_id, state)
+    return state
+
+
+async def create_charger(db: AsyncSession, charger: schemas.ChargerCreate):
+    db_charger = models.Charger(is_reservable = charger.is_reservable, station_id = charger.station_id, reservations=[])
+    db.add(db_charger)
+    await db.execute(crud.bump_station_versions_statement([charger.station_id]))
+    await db.commit()
+    charger_cache.invalidate(db_charger.id)
+    return db_charger
+
+
+async def _set_charger_availability(db: AsyncSession, charger_id: int, is_available: bool, command_id: Optional[int] = None):
+    ''' See crud._set_charger_availability '''
+    result = await db.execute(crud.set_charger_availability_statement(charger_id, is_available, command_id))
+    if result.rowcount == 1:
+        await db.execute(crud.bump_station_versions_statement(crud.stations_of_chargers([charger_id])))
+    await db.commit()
+    if result.rowcount != 1:
+        charger_cache.invalidate(charger_id)
+        return False
+    charger_cache.update(charger_id, lambda state: state._replace(is_available=is_available))
+    return True
+
+
+async def activate_charger(db: AsyncSession, charger_id: int, command_id: Optional[int] = None):
+    return await _set_charger_availability(db, charger_id, False, command_id)
+
+
+async def deactivate_charger(db: AsyncSession, charger_id: int, command_id: Optional[int] = None):
+    return await _set_charger_availability(db, charger_id, True, command_id)
+
+
+# Charging Station
+async def get_charging_station(db: AsyncSession, charging_station_id: int, reservations: schemas.ReservationWindow):
+    result = await db.execute(
+        select(models.ChargingStation)
+        .options(selectinload(models.ChargingStation.chargers))
+        .filter(models.ChargingStation.id == charging_station_id)
+    )
+    db_charging_station = result.scalars().first()
+    if db_charging_station is not None:
+        await _load_reservations(db, db_charging_station.chargers, models.Reservation.charger_id, reservations)
+    return db_charging_station
+
+
+async def charging_station_exists(db: AsyncSession, charging_station_id: int):
+    return (await db.execute(select(exists().where(models.ChargingStation.id == charging_station_id)))).scalar()
+
+
+async def create_charging_station(db: AsyncSession):
+    db_charging_station = models.ChargingStation(chargers=[])
+    db.add(db_charging_station)
+    await db.commit()
+    return db_charging_station
+
+
+# Reservation
+async def get_reservation(db: AsyncSession, reservation_id: int):
+    result = await db.execute(select(models.Reservation).filter(models.Reservation.id == reservation_id))
+    return result.scalars().first()
+
+
+async def is_charger_reserved(db: AsyncSession, charger_id: int, start_time: datetime):
+    result = await db.execute(
+        select(exists().where(models.Reservation.charger_id == charger_id, models.Reservation.slot == utils.get_slot(start_time)))
+    )
+    return result.scalar()
+
+
+async def get_active_reservation(db: AsyncSession, car_id: str, charger_id: int, at: datetime):
+    result = await db.execute(
+        select(models.Reservation).filter(
+            models.Reservation.car_id == car_id,
+            models.Reservation.charger_id == charger_id,
+            models.Reservation.slot == utils.get_slot(at),
+        )
+    )
+    return result.scalars().first()
+
+
+async def create_reservation(db: AsyncSession, reservation: schemas.ReservationCreate):
+    ''' Returns None if the charger is already booked for the time-slot. '''
+    db_reservation = models.Reservation(
+        start_time = reservation.start_time,
+        end_time = reservation.end_time,
+        car_id = reservation.car_id,
+        charger_id = reservation.charger_id,
+        slot = utils.get_slot(reservation.start_time),
+    )
+    db.add(db_reservation)
+    await db.execute(crud.reserve_slot_statement(reservation.charger_id, db_reservation.slot))
+    await db.execute(crud.bump_charger_versions_statement([reservation.charger_id]))
+    await db.execute(crud.bump_station_versions_statement(crud.stations_of_chargers([reservation.charger_id])))
+    try:
+        await db.commit()
+    except IntegrityError: # another request booked the same time-slot first
+        await db.rollback()
+        return None
+    return db_reservation
@@ -0,0 +1,224 @@
+from fastapi import APIRouter
+from sqlalchemy.ext.asyncio import AsyncSession
+import schemas
+from database import get_async_db
+from fastapi import Depends, HTTPException
+import async_crud
+import events
+import utils
+from datetime import datetime
+from functools import partial
+from fastapi.responses import ORJSONResponse
+from typing import Optional
+import models
+from fastapi import Request, Response
+from endpoints import (
+    deactivate_expired_command, get_etag, get_reservation_window, is_not_modified, is_rejected, mqtt_client, new_command_id, parse_fields, 
+    project, projection_columns, validate_reservation_time_slot, wait_for_delivery,
+)
+
+"""
+This file contains async versions of the car, charger, station and reservation endpoints in endpoints.py.
+The router is included before the one in endpoints.py when the server runs in async database mode,
+so these endpoints take precedence. See endpoints.py for documentation of each endpoint.
+"""
+
+router = APIRouter()
+
+
+# Car
+@router.get("/cars/{car_id}", response_model=schemas.Car)
+async def get_car(car_id: str, reservations: schemas.ReservationWindow = Depends(get_reservation_window), fields: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    fields = parse_fields(fields, schemas.Car)
+    columns = projection_columns(models.Car, fields)
+    if columns is not None:
+        db_car = await async_crud.get_columns(db, models.Car, car_id, columns)
+    else:
+        db_car = await async_crud.get_car(db, car_id, reservations)
+    if db_car is None:
+        raise HTTPException(status_code=404, detail="Car not found")
+    if fields is not None:
+        return ORJSONResponse(project(db_car, schemas.Car, fields))
+    return db_car
+
+
+@router.post("/cars/", response_model=schemas.Car)
+async def create_car(car: schemas.CarCreate, db: AsyncSession = Depends(get_async_db)):
+    if await async_crud.car_exists(db, car.id):
+        raise HTTPException(status_code=400, detail="Car already exists")
+    return await async_crud.create_car(db, car)
+
+
+# Charger
+@router.get("/chargers/{charger_id}", response_model=schemas.Charger)
+async def get_charger(
+        charger_id: int, 
+        request: Request, 
+        response: Response, 
+        reservations: schemas.ReservationWindow = Depends(get_reservation_window), 
+        fields: Optional[str] = None, 
+        db: AsyncSession = Depends(get_async_db),
+    ):
+    fields = parse_fields(fields, schemas.Charger)
+    version = await async_crud.get_version(db, models.Charger, charger_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Charger not found")
+    etag = get_etag(version, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    columns = projection_columns(models.Charger, fields)
+    if columns is not None:
+        db_charger = await async_crud.get_columns(db, models.Charger, charger_id, columns)
+    else:
+        db_charger = await async_crud.get_charger(db, charger_id, reservations)
+    if db_charger is None:
+        raise HTTPException(status_code=404, detail="Charger not found")
+    if fields is not None:
+        return ORJSONResponse(project(db_charger, schemas.Charger, fields), headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return db_charger
+
+
+@router.post("/chargers/", response_model=schemas.Charger)
+async def create_charger(charger: schemas.ChargerCreate, db: AsyncSession = Depends(get_async_db)):
+    if not await async_crud.charging_station_exists(db, charger.station_id):
+        raise HTTPException(status_code=400, detail="Station of station_id does not exist")
+
+    return await async_crud.create_charger(db, charger)
+
+
+@router.post("/chargers/{charger_id}/activate/", status_code=200)
+async def activate_charger(activate_charger: schemas.ActivateCharger, charger_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_charger = await async_crud.get_charger_state(db, charger_id)
+    if db_charger is None:
+        raise HTTPException(status_code=404, detail="Charger not found")
+
+    if not await async_crud.car_exists(db, activate_charger.car_id):
+        raise HTTPException(status_code=400, detail="Car not found")
+
+    if not db_charger.is_available:
+        db_charger = await async_crud.get_charger_state(db, charger_id, use_cache=False)
+        if not db_charger.is_available:
+            raise HTTPException(status_code=400, detail="Charger currently is unavailable")
+
+    if activate_charger.target_percentage > 100 or activate_charger.target_percentage <= 0:
+        raise HTTPException(status_code=400, detail="Target percentage is not between 0 and 100.")
+
+    max_charging_time = 30 * 60 # 30 minutes in seconds
+
+    if db_charger.is_reservable:
+        date_now = activate_charger.date_now if activate_charger.date_now is not None else datetime.now()
+        db_reservation = await async_crud.get_active_reservation(db, activate_charger.car_id, charger_id, date_now)
+
+        if db_reservation is not None:
+            max_charging_time = min(utils.get_seconds_until(db_reservation.end_time), 30 * 60)
+        else:
+            raise HTTPException(status_code=400, detail="The car has no reservation for the given charger at this time.")
+
+    command_id = new_command_id()
+    if not await async_crud.activate_charger(db, charger_id, command_id):
+        raise HTTPException(status_code=400, detail="Charger currently is unavailable")
+
+    delivery = mqtt_client.send_start_charging_to_charger(
+        charger_id, command_id, activate_charger.car_id, activate_charger.target_percentage, max_charging_time,
+        on_expired=partial(deactivate_expired_command, charger_id, db_charger.station_id, command_id),
+    )
+    if is_rejected(delivery):
+        await async_crud.deactivate_charger(db, charger_id, command_id)
+        raise HTTPException(status_code=503, detail=f"The start command could not be sent to the charger: {delivery.exception()}")
+
+    events.publish_availability(charger_id, db_charger.station_id, False)
+    events.publish_session_started(charger_id, db_charger.station_id, activate_charger.car_id, activate_charger.target_percentage, max_charging_time)
+
+    if activate_charger.wait_for_delivery:
+        await wait_for_delivery(delivery)
+        return schemas.ActivateChargerReturn(max_charging_time=max_charging_time, delivered=True)
+    return schemas.ActivateChargerReturn(max_charging_time=max_charging_time)
+
+
+@router.post("/chargers/{charger_id}/deactivate/", status_code=200)
+async def deactivate_charger(charger_id: int, command_id: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    if await async_crud.deactivate_charger(db, charger_id, command_id):
+        station_id = (await async_crud.get_charger_state(db, charger_id)).station_id
+        events.publish_availability(charger_id, station_id, True)
+        events.publish_session_stopped(charger_id, station_id)
+        return
+
+    db_charger = await async_crud.get_charger_state(db, charger_id, use_cache=False)
+    if db_charger is None:
+        raise HTTPException(status_code=404, detail="Charger not found")
+    if not db_charger.is_available:
+        raise HTTPException(status_code=400, detail="Charger was activated with another command")
+
+    raise HTTPException(status_code=404, detail="Charger is currently available")
+
+
+# Charging Station
+@router.get("/stations/{station_id}", response_model=schemas.ChargingStation)
+async def get_station(
+        station_id: int, 
+        request: Request, 
+        response: Response, 
+        reservations: schemas.ReservationWindow = Depends(get_reservation_window), 
+        fields: Optional[str] = None, 
+        db: AsyncSession = Depends(get_async_db),
+    ):
+    fields = parse_fields(fields, schemas.ChargingStation)
+    version = await async_crud.get_version(db, models.ChargingStation, station_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Charging station not found")
+    etag = get_etag(version, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    columns = projection_columns(models.ChargingStation, fields)
+    if columns is not None:
+        db_station = await async_crud.get_columns(db, models.ChargingStation, station_id, columns)
+    else:
+        db_station = await async_crud.get_charging_station(db, station_id, reservations)
+    if db_station is None:
+        raise HTTPException(status_code=404, detail="Charging station not found")
+    if fields is not None:
+        return ORJSONResponse(project(db_station, schemas.ChargingStation, fields), headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return db_station
+
+
+@router.post("/stations/", response_model=schemas.ChargingStation)
+async def create_station(db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.create_charging_station(db)
+
+
+# Reservation
+@router.get("/reservations/{reservation_id}", response_model=schemas.Reservation)
+async def get_reservation(reservation_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_reservation = await async_crud.get_reservation(db, reservation_id)
+    if db_reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+
+    return db_reservation
+
+
+@router.post("/reservations/", response_model=schemas.Reservation)
+async def create_reservation(reservation: schemas.ReservationCreate, db: AsyncSession = Depends(get_async_db)):
+    if not await async_crud.car_exists(db, reservation.car_id):
+        raise HTTPException(status_code=400, detail="Car of car_id does not exist")
+
+    db_charger = await async_crud.get_charger_state(db, reservation.charger_id)
+    if db_charger is None:
+        raise HTTPException(status_code=404, detail="Charger of charger_id does not exist")
+
+    if not db_charger.is_reservable:
+        raise HTTPException(status_code=404, detail="Charger of charger_id is not reservable")
+
+    validate_reservation_time_slot(reservation)
+
+    if await async_crud.is_charger_reserved(db, reservation.charger_id, reservation.start_time):
+        raise HTTPException(status_code=400, detail="Charger is already booked for the specified timeslot.")
+
+    db_reservation = await async_crud.create_reservation(db, reservation)
+    if db_reservation is None:
+        raise HTTPException(status_code=400, detail="Charger is already booked for the specified timeslot.")
+
+    return db_reservation
@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import config
+import crud
+import models
+import schemas
+from database import set_sqlite_pragmas
+
+"""
+This file benchmarks the SQLite tuning profile in config.py.
+The same reservation/activation mix is run against a fresh database, once with the SQLite defaults and once with the tuning profile.
+Each thread plays one reservable charger: it books a slot, looks up the reservation, activates and deactivates the charger, and reads it.
+
+Run with: python benchmark.py [threads] [rounds per thread]
+"""
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_worker(SessionLocal, charger_id: int, rounds: int, latencies: list, errors: list):
+    start = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    db = SessionLocal()
+    try:
+        for i in range(rounds):
+            slot_start = start + timedelta(minutes=30 * i)
+            reservation = schemas.ReservationCreate(
+                start_time=slot_start, end_time=slot_start + timedelta(minutes=30), car_id="car", charger_id=charger_id
+            )
+            t = time.perf_counter()
+            try:
+                crud.create_reservation(db, reservation)
+                crud.get_active_reservation(db, "car", charger_id, slot_start)
+                crud.activate_charger(db, charger_id)
+                crud.deactivate_charger(db, charger_id)
+                crud.get_charger(db, charger_id)
+            except OperationalError as e: # e.g. "database is locked"
+                db.rollback()
+                errors.append(e)
+            latencies.append(time.perf_counter() - t)
+    finally:
+        db.close()
+
+
+def run_benchmark(pragmas: dict, threads: int, rounds: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'db.sqlite')}", connect_args={"check_same_thread": False})
+        if pragmas:
+            set_sqlite_pragmas(engine, pragmas)
+        models.Base.metadata.create_all(bind=engine)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        db = SessionLocal()
+        crud.create_car(db, schemas.CarCreate(id="car"))
+        crud.create_charging_station(db)
+        for _ in range(threads):
+            crud.create_charger(db, schemas.ChargerCreate(is_reservable=True, station_id=1))
+        db.close()
+
+        latencies, errors = [], []
+        workers = [
+            threading.Thread(target=run_worker, args=(SessionLocal, charger_id, rounds, latencies, errors))
+            for charger_id in range(1, threads + 1)
+        ]
+        t = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - t
+        engine.dispose()
+
+    return {
+        "rounds/s": len(latencies) / elapsed,
+        "p50 ms": percentile(latencies, 0.5) * 1000,
+        "p99 ms": percentile(latencies, 0.99) * 1000,
+        "errors": len(errors),
+    }
+
+
+def run():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print(f"{threads} threads x {rounds} rounds (reserve, lookup, activate, deactivate, read)")
+
+    for name, pragmas in [("SQLite defaults", {}), ("Tuning profile", config.SQLITE_PRAGMAS)]:
+        result = run_benchmark(pragmas, threads, rounds)
+        print(f"{name:16}" + "".join(f"  {key}: {value:8.1f}" if isinstance(value, float) else f"  {key}: {value:8}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+import config
+
+"""
+This file contains the in-process cache of car existence and charger state.
+Cars and chargers rarely change, so the activation and reservation endpoints read them from here instead of the database.
+The crud write methods invalidate or update the entries they change.
+
+The cache is local to the server process. The availability of a charger is therefore only a hint,
+the compare-and-set in crud.activate_charger decides if a charger can be activated.
+"""
+
+
+class ChargerState(NamedTuple):
+    id: int
+    is_reservable: bool
+    is_available: bool
+    station_id: int
+
+
+class LRUCache:
+    ''' Thread-safe cache holding at most max_size entries. The least recently used entry is evicted first. '''
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        ''' Returns the cached value, or None on a miss. '''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def update(self, key, fn):
+        ''' Replaces a cached value with fn(value), if the key is cached. '''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries[key] = fn(value)
+
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+# Car id -> True, only existing cars are cached
+car_cache = LRUCache(config.CACHE_SIZE)
+
+# Charger id -> ChargerState
+charger_cache = LRUCache(config.CACHE_SIZE)
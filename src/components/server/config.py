@@ -0,0 +1,65 @@
+import os
+
+"""
+This file contains the configuration of the server.
+Every setting can be overridden by setting an environment variable with the same name.
+"""
+
+# "sync" serves all endpoints with regular database sessions.
+# "async" serves the car, charger, station and reservation endpoints with async (aiosqlite) sessions instead.
+DATABASE_MODE = os.environ.get("DATABASE_MODE", "sync")
+
+# SQLite tuning profile, applied to every new database connection. 
+# Set SQLITE_TUNING=off to use the SQLite defaults (rollback journal, and a fsync for every commit).
+SQLITE_TUNING = os.environ.get("SQLITE_TUNING", "on")
+SQLITE_PRAGMAS = {
+    # Readers do not block behind writers, and commits append to the WAL file instead of rewriting pages
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    # In WAL mode only checkpoints fsync, a commit can be lost on power loss but the database is never corrupted
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 64 * 1024 * 1024)), # bytes
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", -16000)), # negative values are in KiB
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)), # milliseconds to wait for a lock
+    "temp_store": os.environ.get("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+# When "on", all writes of the sync endpoints are executed by a single writer thread (see writer.py).
+# Pending writes are grouped into one transaction, which is committed when it has WRITE_BATCH_SIZE writes,
+# or WRITE_BATCH_DELAY milliseconds after the first write of the batch arrived.
+WRITE_COORDINATOR = os.environ.get("WRITE_COORDINATOR", "off")
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 64))
+WRITE_BATCH_DELAY = float(os.environ.get("WRITE_BATCH_DELAY", 2))
+
+# Maximum number of cars, and of chargers, kept in the in-process cache (see cache.py). 0 disables the cache.
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 10000))
+
+# Maximum number of events queued for one client of the /events endpoints, before it is told to resync (see events.py).
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 256))
+# Seconds without events after which a keepalive is sent, so proxies keep the connection open and closed clients are noticed.
+EVENT_KEEPALIVE = float(os.environ.get("EVENT_KEEPALIVE", 15))
+
+# Address of the HTTP server, and the number of server processes.
+# With more than one worker, every worker has its own MQTT client, cache, write coordinator and event broker,
+# so /events only streams the changes made through the worker the client is connected to.
+SERVER_HOST = os.environ.get("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 8000))
+WORKERS = int(os.environ.get("WORKERS", 1))
+
+# MQTT broker of the server. The server connects in the background, and retries with a delay that doubles
+# from MQTT_RECONNECT_MIN_DELAY up to MQTT_RECONNECT_MAX_DELAY seconds, until the broker is reachable.
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "test.mosquitto.org")
+MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
+MQTT_RECONNECT_MIN_DELAY = int(os.environ.get("MQTT_RECONNECT_MIN_DELAY", 1))
+MQTT_RECONNECT_MAX_DELAY = int(os.environ.get("MQTT_RECONNECT_MAX_DELAY", 30))
+
+# Publishing of the MQTT commands sent to the chargers (see mqtt.py).
+# At QoS 1 a command is delivered when the broker acknowledges it, and commands published while the broker is unreachable
+# are queued and sent after reconnecting. At most MQTT_MAX_QUEUED commands are queued or unacknowledged at once,
+# and a command that is not acknowledged within MQTT_ACK_TIMEOUT seconds is reported as timed out.
+# A start command expires MQTT_COMMAND_TTL seconds after it was published: the charger ignores it after that,
+# and if the broker has not acknowledged it by then, the charger is made available again.
+# The charger compares the expiry with its own clock, so the TTL must be well above the clock difference of server and chargers.
+MQTT_QOS = int(os.environ.get("MQTT_QOS", 1))
+MQTT_MAX_QUEUED = int(os.environ.get("MQTT_MAX_QUEUED", 1000))
+MQTT_ACK_TIMEOUT = float(os.environ.get("MQTT_ACK_TIMEOUT", 5))
+MQTT_COMMAND_TTL = float(os.environ.get("MQTT_COMMAND_TTL", 300))
@@ -1,99 +1,509 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Optional
 
-import models, schemas
+import models, schemas, utils
+from cache import ChargerState, car_cache, charger_cache
 
 """
 This file contains methods used for interacting directly with the database. 
+
+The get_all_<entity> methods return whole tables by default. For keyset pagination, pass the id of 
+the last row of the previous page as 'after', and the page size as 'limit'. Rows are ordered by id.
 """
 
 
+# Embedded reservations
+def reservations_query(foreign_key, parent_ids: list, window: schemas.ReservationWindow):
+    ''' 
+    Query for the reservations of many cars or chargers at once, limited by the window. 
+    foreign_key is the column of Reservation that points to the parents, e.g. Reservation.charger_id.
+    '''
+    query = select(models.Reservation).where(foreign_key.in_(parent_ids))
+    if window.reservations_from is not None:
+        query = query.where(models.Reservation.slot >= utils.get_slot(window.reservations_from))
+    if window.reservations_until is not None:
+        query = query.where(models.Reservation.slot < utils.get_slot_after(window.reservations_until))
+
+    if window.reservations_limit is None:
+        return query.order_by(models.Reservation.slot)
+
+    # Number the reservations of each parent by start time, and only keep the first ones
+    row_number = func.row_number().over(partition_by=foreign_key, order_by=models.Reservation.slot).label("row_number")
+    subquery = query.add_columns(row_number).subquery()
+    reservation = aliased(models.Reservation, subquery)
+    return select(reservation).where(subquery.c.row_number <= window.reservations_limit).order_by(reservation.slot)
+
+
+def assign_reservations(parents: list, reservations: list, foreign_key_name: str):
+    ''' Sets the loaded reservations on their parents, so accessing parent.reservations does not query the database. '''
+    grouped = defaultdict(list)
+    for reservation in reservations:
+        grouped[getattr(reservation, foreign_key_name)].append(reservation)
+    for parent in parents:
+        set_committed_value(parent, "reservations", grouped[parent.id])
+
+
+def _load_reservations(db: Session, parents: list, foreign_key, window: schemas.ReservationWindow):
+    if parents:
+        reservations = db.scalars(reservations_query(foreign_key, [parent.id for parent in parents], window)).all()
+        assign_reservations(parents, reservations, foreign_key.key)
+
+
+# Column projections
+def is_column_projection(model, fields: list[str]):
+    ''' True if every field is a column of the model, so the fields can be read without loading any relationships. '''
+    return set(fields) <= set(model.__table__.columns.keys())
+
+
+def select_columns(model, columns: list[str]):
+    ''' The columns of the model with the given names. The id is always selected, as it is used as the pagination cursor. '''
+    return [model.id] + [getattr(model, column) for column in columns if column != "id"]
+
+
+def get_columns(db: Session, model, id, columns: list[str]):
+    ''' Returns only the given columns of the row with the id, or None if there is no such row. '''
+    return db.query(*select_columns(model, columns)).filter(model.id == id).first()
+
+
+# Versions
+# Chargers and stations have a version, which every write that changes their GET payload increments in the same transaction.
+# The payload of a station embeds its chargers and their reservations, so a write to a charger increments the version of its station too.
+def get_version(db: Session, model, id):
+    ''' Returns the version of the charger or station with the id, or None if there is no such row. '''
+    return db.query(model.version).filter(model.id == id).scalar()
+
+
+def bump_charger_versions_statement(charger_ids: list[int]):
+    return update(models.Charger).where(models.Charger.id.in_(charger_ids)).values(version=models.Charger.version + 1)
+
+
+def bump_station_versions_statement(station_ids):
+    ''' station_ids is a list of ids, or a select of ids, e.g. stations_of_chargers(). '''
+    return update(models.ChargingStation).where(models.ChargingStation.id.in_(station_ids)).values(version=models.ChargingStation.version + 1)
+
+
+def stations_of_chargers(charger_ids: list[int]):
+    return select(models.Charger.station_id).where(models.Charger.id.in_(charger_ids))
+
+
 # Car
-def get_car(db: Session, car_id: str):
-    return db.query(models.Car).filter(models.Car.id == car_id).first()
+def get_car(db: Session, car_id: str, reservations: Optional[schemas.ReservationWindow] = None):
+    ''' The reservations of the car are loaded up front, in a single query, if a window is given. '''
+    db_car = db.query(models.Car).filter(models.Car.id == car_id).first()
+    if db_car is not None and reservations is not None:
+        _load_reservations(db, [db_car], models.Reservation.car_id, reservations)
+    return db_car
+
 
+def car_exists(db: Session, car_id: str):
+    ''' Checks if a car exists, using the cache when possible. '''
+    if car_cache.get(car_id):
+        return True
+    if not db.query(exists().where(models.Car.id == car_id)).scalar():
+        return False
+    car_cache.put(car_id, True)
+    return True
 
-def get_all_cars(db: Session):
-    return db.query(models.Car).all()
+
+def get_all_cars(db: Session, after: Optional[str] = None, limit: Optional[int] = None, columns: Optional[list[str]] = None):
+    ''' Returns rows with only the given columns if columns is given, and cars with their reservations otherwise. '''
+    if columns is not None:
+        query = db.query(*select_columns(models.Car, columns)).order_by(models.Car.id)
+    else:
+        query = db.query(models.Car).options(selectinload(models.Car.reservations)).order_by(models.Car.id)
+    if after is not None:
+        query = query.filter(models.Car.id > after)
+    return query.limit(limit).all()
 
 def create_car(db: Session, car: schemas.CarCreate):
-    db_car = models.Car(id=car.id)
+    db_car = models.Car(id=car.id, reservations=[])
     db.add(db_car)
     db.commit()
+    car_cache.invalidate(car.id)
     db.refresh(db_car)
     return db_car
 
 
+def create_cars(db: Session, cars: list[schemas.CarCreate]):
+    ''' Inserts the cars with one statement, skipping ids that already exist. Returns the set of ids that were inserted. '''
+    if not cars:
+        return set()
+    inserted_ids = db.scalars(
+        insert(models.Car).prefix_with("OR IGNORE").returning(models.Car.id),
+        [{"id": car.id} for car in cars],
+    ).all()
+    db.commit()
+    for car_id in inserted_ids:
+        car_cache.invalidate(car_id)
+    return set(inserted_ids)
+
+
+def get_existing_car_ids(db: Session, car_ids: list[str]):
+    ''' Returns the subset of the given ids that belong to a car, using a single query. '''
+    rows = db.query(models.Car.id).filter(models.Car.id.in_(set(car_ids))).all()
+    return {row.id for row in rows}
+
+
 # Charger
-def get_charger(db: Session, charger_id : int):
-    return db.query(models.Charger).filter(models.Charger.id == charger_id).first()
+def get_charger(db: Session, charger_id : int, reservations: Optional[schemas.ReservationWindow] = None):
+    ''' The reservations of the charger are loaded up front, in a single query, if a window is given. '''
+    db_charger = db.query(models.Charger).filter(models.Charger.id == charger_id).first()
+    if db_charger is not None and reservations is not None:
+        _load_reservations(db, [db_charger], models.Reservation.charger_id, reservations)
+    return db_charger
 
 
-def get_all_chargers(db: Session):
-    return db.query(models.Charger).all()
+def get_charger_state(db: Session, charger_id: int, use_cache: bool = True):
+    ''' Returns the ChargerState of a charger, using the cache when possible. Returns None if the charger does not exist. '''
+    if use_cache:
+        state = charger_cache.get(charger_id)
+        if state is not None:
+            return state
+    row = db.query(
+        models.Charger.id, models.Charger.is_reservable, models.Charger.is_available, models.Charger.station_id
+    ).filter(models.Charger.id == charger_id).first()
+    if row is None:
+        return None
+    state = ChargerState(*row)
+    charger_cache.put(charger_id, state)
+    return state
+
+
+def get_all_chargers(
+        db: Session, 
+        after: Optional[int] = None, 
+        limit: Optional[int] = None, 
+        is_available: Optional[bool] = None, 
+        is_reservable: Optional[bool] = None, 
+        station_id: Optional[int] = None,
+        columns: Optional[list[str]] = None,
+    ):
+    ''' Returns rows with only the given columns if columns is given, and chargers with their reservations otherwise. '''
+    if columns is not None:
+        query = db.query(*select_columns(models.Charger, columns)).order_by(models.Charger.id)
+    else:
+        query = db.query(models.Charger).options(selectinload(models.Charger.reservations)).order_by(models.Charger.id)
+    if after is not None:
+        query = query.filter(models.Charger.id > after)
+    if is_available is not None:
+        query = query.filter(models.Charger.is_available == is_available)
+    if is_reservable is not None:
+        query = query.filter(models.Charger.is_reservable == is_reservable)
+    if station_id is not None:
+        query = query.filter(models.Charger.station_id == station_id)
+    return query.limit(limit).all()
 
 
 def create_charger(db: Session, charger: schemas.ChargerCreate):
-    db_charger = models.Charger(is_reservable = charger.is_reservable, station_id = charger.station_id)
+    db_charger = models.Charger(is_reservable = charger.is_reservable, station_id = charger.station_id, reservations=[])
     db.add(db_charger)
+    db.execute(bump_station_versions_statement([charger.station_id]))
     db.commit()
     db.refresh(db_charger)
+    charger_cache.invalidate(db_charger.id)
     return db_charger
 
-def activate_charger(db: Session, charger_id: int):
-    db_charger = db.query(models.Charger).filter(models.Charger.id == charger_id).first()
-    if db_charger is not None: # TODO: add error handling
-        db_charger.is_available = False
-        db.commit()
-        db.refresh(db_charger)
-        return db_charger
+def create_chargers(db: Session, chargers: list[schemas.ChargerCreate]):
+    ''' Inserts the chargers with one statement. Returns the ids of the new chargers, in the same order as the given chargers. '''
+    if not chargers:
+        return []
+    charger_ids = db.scalars(
+        insert(models.Charger).returning(models.Charger.id, sort_by_parameter_order=True),
+        [{"is_reservable": charger.is_reservable, "station_id": charger.station_id, "is_available": True} for charger in chargers],
+    ).all()
+    db.execute(bump_station_versions_statement(list({charger.station_id for charger in chargers})))
+    db.commit()
+    for charger_id in charger_ids:
+        charger_cache.invalidate(charger_id)
+    return charger_ids
+
+
+def set_charger_availability_statement(charger_id: int, is_available: bool, command_id: Optional[int] = None):
+    '''
+    Compare-and-set of the availability of a charger, as a single UPDATE statement.
+    Activating stores the id of the start command sent to the charger. Deactivating with a command id only succeeds if it
+    is still the command of the charger, so a late report about an old command does not end the session of a newer one.
+    '''
+    conditions = [models.Charger.id == charger_id, models.Charger.is_available == (not is_available)]
+    if is_available and command_id is not None:
+        conditions.append(models.Charger.command_id == command_id)
+    return (
+        update(models.Charger)
+        .where(*conditions)
+        .values(is_available=is_available, command_id=None if is_available else command_id, version=models.Charger.version + 1)
+    )
+
+
+def _set_charger_availability(db: Session, charger_id: int, is_available: bool, command_id: Optional[int] = None):
+    ''' 
+    See set_charger_availability_statement.
+    Returns True if the availability was changed, and False if the charger does not exist, already had the given availability,
+    or has another command.
+    '''
+    result = db.execute(set_charger_availability_statement(charger_id, is_available, command_id))
+    if result.rowcount == 1:
+        db.execute(bump_station_versions_statement(stations_of_chargers([charger_id])))
+    db.commit()
+    if result.rowcount != 1:
+        charger_cache.invalidate(charger_id) # the cached availability may be stale
+        return False
+    charger_cache.update(charger_id, lambda state: state._replace(is_available=is_available))
+    return True
+
+
+def activate_charger(db: Session, charger_id: int, command_id: Optional[int] = None):
+    ''' Makes an available charger unavailable. Only one of several concurrent activations will return True. '''
+    return _set_charger_availability(db, charger_id, False, command_id)
+
+
+def deactivate_charger(db: Session, charger_id: int, command_id: Optional[int] = None):
+    ''' Makes an unavailable charger available again. With a command id, only if the charger was activated with that command. '''
+    return _set_charger_availability(db, charger_id, True, command_id)
 
 def update_charger(db: Session, charger_id: int, updated_charger: schemas.ChargerUpdate):
     db_charger = db.query(models.Charger).filter(models.Charger.id == charger_id).first()
     if db_charger is not None: # TODO: add error handling
         if updated_charger.is_reservable is not None:
-            db_charger.is_reservable = update_charger.is_reservable
+            db_charger.is_reservable = updated_charger.is_reservable
         if updated_charger.is_available is not None:
             db_charger.is_available = updated_charger.is_available
+        db_charger.version = models.Charger.version + 1
+        db.execute(bump_station_versions_statement([db_charger.station_id]))
         
         db.commit()
         db.refresh(db_charger)
+        charger_cache.invalidate(charger_id)
         return db_charger
 
 
 # Charging Station
-def get_charging_station(db: Session, charging_station_id: int):
-    return db.query(models.ChargingStation).filter(models.ChargingStation.id == charging_station_id).first()
+def get_charging_station(db: Session, charging_station_id: int, reservations: Optional[schemas.ReservationWindow] = None):
+    ''' 
+    If a window is given, the chargers of the station and their reservations are loaded up front. 
+    This takes three queries, no matter how many chargers the station has.
+    '''
+    query = db.query(models.ChargingStation).filter(models.ChargingStation.id == charging_station_id)
+    if reservations is None:
+        return query.first()
 
+    db_charging_station = query.options(selectinload(models.ChargingStation.chargers)).first()
+    if db_charging_station is not None:
+        _load_reservations(db, db_charging_station.chargers, models.Reservation.charger_id, reservations)
+    return db_charging_station
 
-def get_all_charging_stations(db: Session):
-    return db.query(models.ChargingStation).all()
+
+def get_all_charging_stations(db: Session, after: Optional[int] = None, limit: Optional[int] = None, columns: Optional[list[str]] = None):
+    ''' Returns rows with only the given columns if columns is given, and stations with their chargers otherwise. '''
+    if columns is not None:
+        query = db.query(*select_columns(models.ChargingStation, columns)).order_by(models.ChargingStation.id)
+    else:
+        query = db.query(models.ChargingStation).options(
+            selectinload(models.ChargingStation.chargers).selectinload(models.Charger.reservations)
+        ).order_by(models.ChargingStation.id)
+    if after is not None:
+        query = query.filter(models.ChargingStation.id > after)
+    return query.limit(limit).all()
 
 
 def create_charging_station(db: Session):
-    db_charging_station = models.ChargingStation()
+    db_charging_station = models.ChargingStation(chargers=[])
     db.add(db_charging_station)
     db.commit()
     db.refresh(db_charging_station)
     return db_charging_station
 
 
+def get_existing_charging_station_ids(db: Session, charging_station_ids: list[int]):
+    ''' Returns the subset of the given ids that belong to a charging station, using a single query. '''
+    rows = db.query(models.ChargingStation.id).filter(models.ChargingStation.id.in_(set(charging_station_ids))).all()
+    return {row.id for row in rows}
+
+
+def create_charging_stations(db: Session, count: int):
+    ''' Inserts count charging stations with one statement. Returns the ids of the new stations. '''
+    if count <= 0:
+        return []
+    charging_station_ids = db.scalars(
+        insert(models.ChargingStation).returning(models.ChargingStation.id, sort_by_parameter_order=True),
+        [{"id": None} for _ in range(count)],
+    ).all()
+    db.commit()
+    return charging_station_ids
+
+
 # Reservation
 def get_reservation(db: Session, reservation_id: int):
     return db.query(models.Reservation).filter(models.Reservation.id == reservation_id).first()
 
 
-def get_all_reservations(db: Session):
-    return db.query(models.Reservation).all()
+def get_all_reservations(
+        db: Session, 
+        after: Optional[int] = None, 
+        limit: Optional[int] = None, 
+        car_id: Optional[str] = None, 
+        charger_id: Optional[int] = None, 
+        start: Optional[datetime] = None, 
+        end: Optional[datetime] = None,
+    ):
+    ''' The start and end filters return the reservations overlapping the time window [start, end). '''
+    query = db.query(models.Reservation).order_by(models.Reservation.id)
+    if after is not None:
+        query = query.filter(models.Reservation.id > after)
+    if car_id is not None:
+        query = query.filter(models.Reservation.car_id == car_id)
+    if charger_id is not None:
+        query = query.filter(models.Reservation.charger_id == charger_id)
+    if start is not None:
+        query = query.filter(models.Reservation.slot >= utils.get_slot(start))
+    if end is not None:
+        query = query.filter(models.Reservation.slot < utils.get_slot_after(end))
+    return query.limit(limit).all()
+
+
+def is_charger_reserved(db: Session, charger_id: int, start_time: datetime):
+    ''' Checks if a charger is booked for the time-slot starting at start_time, using the (charger_id, slot) index. '''
+    return db.query(
+        exists().where(models.Reservation.charger_id == charger_id, models.Reservation.slot == utils.get_slot(start_time))
+    ).scalar()
+
+
+def get_active_reservation(db: Session, car_id: str, charger_id: int, at: datetime):
+    ''' Returns the reservation of the car on the charger covering the given time, or None. '''
+    # Every reservation is one slot, so the reservation covering 'at' is the one of the slot containing it
+    return db.query(models.Reservation).filter(
+        models.Reservation.car_id == car_id,
+        models.Reservation.charger_id == charger_id,
+        models.Reservation.slot == utils.get_slot(at),
+    ).first()
 
 
 def create_reservation(db: Session, reservation: schemas.ReservationCreate):
+    ''' Returns None if the charger is already booked for the time-slot. '''
     db_reservation = models.Reservation(
         start_time = reservation.start_time, 
         end_time = reservation.end_time, 
         car_id = reservation.car_id,
-        charger_id = reservation.charger_id
+        charger_id = reservation.charger_id,
+        slot = utils.get_slot(reservation.start_time),
     )
     db.add(db_reservation)
-    db.commit()
+    db.execute(reserve_slot_statement(reservation.charger_id, db_reservation.slot))
+    db.execute(bump_charger_versions_statement([reservation.charger_id]))
+    db.execute(bump_station_versions_statement(stations_of_chargers([reservation.charger_id])))
+    try:
+        db.commit()
+    except IntegrityError: # another request booked the same time-slot first
+        db.rollback()
+        return None
     db.refresh(db_reservation)
     return db_reservation
+
+
+def create_reservations(db: Session, reservations: list[schemas.ReservationCreate]):
+    '''
+    Inserts the reservations, and sets their slots in the bitmaps, in one transaction.
+    Returns the new reservations in the same order, or None if one of the slots was already booked, in which case nothing is inserted.
+    '''
+    if not reservations:
+        return []
+    rows = [
+        {
+            "start_time": reservation.start_time, 
+            "end_time": reservation.end_time, 
+            "car_id": reservation.car_id, 
+            "charger_id": reservation.charger_id, 
+            "slot": utils.get_slot(reservation.start_time),
+        }
+        for reservation in reservations
+    ]
+    bitmaps = defaultdict(int)
+    for row in rows:
+        bitmaps[(row["charger_id"], utils.get_slot_day(row["slot"]))] |= 1 << utils.get_slot_of_day(row["slot"])
+    try:
+        reservation_ids = db.scalars(
+            insert(models.Reservation).returning(models.Reservation.id, sort_by_parameter_order=True), rows
+        ).all()
+        for (charger_id, day), bitmap in bitmaps.items():
+            db.execute(reserve_slots_statement(charger_id, day, bitmap))
+        charger_ids = list({row["charger_id"] for row in rows})
+        db.execute(bump_charger_versions_statement(charger_ids))
+        db.execute(bump_station_versions_statement(stations_of_chargers(charger_ids)))
+        db.commit()
+    except IntegrityError: # another request booked one of the slots first
+        db.rollback()
+        return None
+    return [schemas.Reservation(id=reservation_id, **reservation.model_dump()) for reservation_id, reservation in zip(reservation_ids, reservations)]
+
+
+# Reserved slot bitmaps
+def reserve_slot_statement(charger_id: int, slot: int):
+    ''' Statement setting the bit of the slot in the bitmap of the charger for the day of the slot. '''
+    return reserve_slots_statement(charger_id, utils.get_slot_day(slot), 1 << utils.get_slot_of_day(slot))
+
+
+def reserve_slots_statement(charger_id: int, day: date, reserved_slots: int):
+    ''' Statement setting the bits of reserved_slots in the bitmap of the charger for the day. '''
+    statement = sqlite_insert(models.ChargerSlotDay).values(charger_id=charger_id, day=day, reserved_slots=reserved_slots)
+    return statement.on_conflict_do_update(
+        index_elements=[models.ChargerSlotDay.charger_id, models.ChargerSlotDay.day],
+        set_={"reserved_slots": models.ChargerSlotDay.reserved_slots.op("|")(statement.excluded.reserved_slots)},
+    )
+
+
+def get_reserved_slots(db: Session, charger_ids: list[int], start_day: date, end_day: date):
+    ''' Returns the reserved slot bitmaps of the chargers from start_day to end_day (inclusive), as {(charger_id, day): bitmap}. '''
+    rows = db.query(models.ChargerSlotDay).filter(
+        models.ChargerSlotDay.charger_id.in_(charger_ids),
+        models.ChargerSlotDay.day >= start_day,
+        models.ChargerSlotDay.day <= end_day,
+    ).all()
+    return {(row.charger_id, row.day): row.reserved_slots for row in rows}
+
+
+def get_reservable_chargers(db: Session, station_id: Optional[int] = None):
+    ''' Returns the id and station_id of the reservable chargers, optionally only those of one station. '''
+    query = db.query(models.Charger.id, models.Charger.station_id).filter(models.Charger.is_reservable == True).order_by(models.Charger.id)
+    if station_id is not None:
+        query = query.filter(models.Charger.station_id == station_id)
+    return query.all()
+
+
+def get_reservable_charger_ids(db: Session, station_id: Optional[int] = None):
+    return [row.id for row in get_reservable_chargers(db, station_id)]
+
+
+def get_cars_reserved_slots(db: Session, car_ids: list[str], start_slot: int, end_slot: int):
+    ''' Returns the slots from start_slot up to end_slot reserved by the cars, as {(car_id, day): bitmap}. '''
+    bitmaps = defaultdict(int)
+    rows = db.query(models.Reservation.car_id, models.Reservation.slot).filter(
+        models.Reservation.car_id.in_(set(car_ids)),
+        models.Reservation.slot >= start_slot,
+        models.Reservation.slot < end_slot,
+    )
+    for car_id, slot in rows:
+        bitmaps[(car_id, utils.get_slot_day(slot))] |= 1 << utils.get_slot_of_day(slot)
+    return bitmaps
+
+
+def rebuild_reserved_slots(db: Session, since: date):
+    ''' Recomputes the slot bitmaps of all days from since, from the reservations. Used when the bitmaps are first created. '''
+    bitmaps = defaultdict(int)
+    reservations = db.query(models.Reservation.charger_id, models.Reservation.slot).filter(
+        models.Reservation.slot >= utils.get_first_slot_of_day(since)
+    )
+    for charger_id, slot in reservations:
+        bitmaps[(charger_id, utils.get_slot_day(slot))] |= 1 << utils.get_slot_of_day(slot)
+
+    db.query(models.ChargerSlotDay).filter(models.ChargerSlotDay.day >= since).delete()
+    if bitmaps:
+        db.execute(
+            insert(models.ChargerSlotDay),
+            [{"charger_id": charger_id, "day": day, "reserved_slots": bitmap} for (charger_id, day), bitmap in bitmaps.items()],
+        )
+    db.commit()
@@ -1,21 +1,67 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+import config
+
 # Chosen database engine and the path to database file
 SQLALCHEMY_DATABASE_URL = "sqlite:///./db.sqlite"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./db.sqlite"
+
+
+def set_sqlite_pragmas(engine, pragmas: dict):
+    ''' Executes the given PRAGMA statements on every new connection of the engine. '''
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if config.SQLITE_TUNING == "on":
+    set_sqlite_pragmas(engine, config.SQLITE_PRAGMAS)
+
+# With the write coordinator all writes are done by the writer (see writer.py),
+# so the sessions of the endpoints use their own read-only connections.
+session_engine = engine
+if config.WRITE_COORDINATOR == "on":
+    session_engine = create_engine(
+        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    )
+    if config.SQLITE_TUNING == "on":
+        set_sqlite_pragmas(session_engine, config.SQLITE_PRAGMAS)
+    set_sqlite_pragmas(session_engine, {"query_only": "ON"})
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=session_engine)
 
 Base = declarative_base()
 
+# The async engine is only created in async mode, so aiosqlite is not needed otherwise
+async_engine = None
+AsyncSessionLocal = None
+
+if config.DATABASE_MODE == "async":
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+    if config.SQLITE_TUNING == "on":
+        set_sqlite_pragmas(async_engine.sync_engine, config.SQLITE_PRAGMAS)
+    # Objects are not expired on commit, since expired attributes can not be lazy loaded in async sessions
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
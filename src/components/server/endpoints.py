@@ -1,44 +1,247 @@
 from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import Row
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+import orjson
 import schemas
-from database import get_db
-from fastapi import Depends, HTTPException
+from database import get_db, SessionLocal
+from fastapi import Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from typing import Literal, Optional
 import crud
-from mqtt import MQTTClient
+from mqtt import MQTTClient, PublishError, new_command_id
 import utils
 import models
+import config
+import cache
+import events
+from writer import WriteCoordinator
+from datetime import date, datetime, timedelta
+import asyncio
+import heapq
+from concurrent.futures import Future
+import zlib
+from collections import defaultdict
+from functools import partial
+import planner
 
 """
 This file contains definitions for all the REST API endpoints of the server.
 """
 
 router = APIRouter()
+
+# Started and stopped by the lifespan of the app, see run.py
 mqtt_client = MQTTClient()
-mqtt_client.start()
+write_coordinator = WriteCoordinator() if config.WRITE_COORDINATOR == "on" else None
+
+
+def write(db: Session, fn, *args):
+    ''' Executes the crud write fn, through the write coordinator if it is enabled. '''
+    if write_coordinator is not None:
+        return write_coordinator.execute(fn, *args)
+    return fn(db, *args)
+
+
+# Field selection
+def parse_fields(fields: Optional[str], item_schema) -> Optional[list[str]]:
+    ''' Splits a comma separated fields parameter, e.g. "id,is_available". Raises a HTTPException for unknown fields. '''
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in item_schema.model_fields]
+    if not names or unknown:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Unknown fields: {', '.join(unknown)}. The fields are: {', '.join(item_schema.model_fields)}",
+        )
+    return names
+
+
+def project(item, item_schema, fields: list[str]) -> dict:
+    ''' Returns the given fields of a row or ORM object. Nested fields, like reservations, are serialized through item_schema. '''
+    if isinstance(item, Row):
+        return {field: getattr(item, field) for field in fields}
+    return item_schema.model_validate(item).model_dump(mode="json", include=set(fields))
+
+
+def _stream_ndjson(fetch_page, item_schema, after, page_size: int, fields: Optional[list[str]] = None):
+    ''' Yields every row from fetch_page as a JSON line, fetching page_size rows at a time so memory use stays bounded. '''
+    # The session of the request is closed before the response is streamed, so the stream uses its own
+    db = SessionLocal()
+    try:
+        while True:
+            items = fetch_page(db, after, page_size)
+            for item in items:
+                if fields is not None:
+                    yield orjson.dumps(project(item, item_schema, fields)) + b"\n"
+                else:
+                    yield item_schema.model_validate(item).model_dump_json().encode() + b"\n"
+            if len(items) < page_size:
+                break
+            after = items[-1].id
+            db.expunge_all()
+    finally:
+        db.close()
+
+
+def paginate(db: Session, fetch_page, item_schema, after, limit: int, format: str, fields: Optional[list[str]] = None):
+    '''
+    Returns one page of fetch_page(db, after, limit) with the cursor of the next page.
+    With format=ndjson, all rows after the cursor are instead streamed as newline delimited JSON, fetched limit rows at a time.
+    If fields is given, the items only contain those fields, and are serialized directly instead of through the response model.
+    '''
+    if format == "ndjson":
+        return StreamingResponse(_stream_ndjson(fetch_page, item_schema, after, limit, fields), media_type="application/x-ndjson")
+
+    items = fetch_page(db, after, limit)
+    next_cursor = items[-1].id if len(items) == limit else None
+    if fields is not None:
+        return ORJSONResponse({"items": [project(item, item_schema, fields) for item in items], "next_cursor": next_cursor})
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def projection_columns(model, fields: Optional[list[str]]):
+    ''' The fields, if they can be read as columns only. None if all fields were requested, or a nested field was. '''
+    if fields is not None and crud.is_column_projection(model, fields):
+        return fields
+    return None
+
+# Reservation windows
+def get_reservation_window(reservations: schemas.ReservationWindow = Depends()):
+    ''' The reservation window query parameters. The reservation times are naive, so aware bounds can not be compared to them. '''
+    if any(d is not None and utils.is_date_aware(d) for d in (reservations.reservations_from, reservations.reservations_until)):
+        raise HTTPException(
+            status_code=400, 
+            detail="reservations_from or reservations_until is aware, e.g. specified with a timezone. The dates should be naive.",
+        )
+    return reservations
+
+
+# Conditional requests
+def get_etag(version: int, request: Request):
+    ''' ETag of a charger or station payload. The query string changes the payload (reservation window, fields), so it is part of the tag. '''
+    return f'"{version}-{zlib.crc32(request.url.query.encode()):08x}"'
+
+
+def is_not_modified(request: Request, etag: str):
+    ''' True if the If-None-Match header of the request matches the etag. '''
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
 
 # Car
+@router.get("/cars/", response_model=schemas.Page[schemas.Car])
+def get_cars(
+        after: Optional[str] = None, 
+        limit: int = Query(100, ge=1, le=1000), 
+        format: Literal["json", "ndjson"] = "json", 
+        fields: Optional[str] = None,
+        db: Session = Depends(get_db),
+    ):
+    fields = parse_fields(fields, schemas.Car)
+    columns = projection_columns(models.Car, fields)
+    def fetch_page(db, after, limit):
+        return crud.get_all_cars(db, after, limit, columns)
+    return paginate(db, fetch_page, schemas.Car, after, limit, format, fields)
+
+
 @router.get("/cars/{car_id}", response_model=schemas.Car)
-def get_car(car_id: str, db: Session = Depends(get_db)):
-    db_car = crud.get_car(db, car_id)
+def get_car(car_id: str, reservations: schemas.ReservationWindow = Depends(get_reservation_window), fields: Optional[str] = None, db: Session = Depends(get_db)):
+    fields = parse_fields(fields, schemas.Car)
+    columns = projection_columns(models.Car, fields)
+    if columns is not None:
+        db_car = crud.get_columns(db, models.Car, car_id, columns)
+    else:
+        db_car = crud.get_car(db, car_id, reservations)
     if db_car is None:
         raise HTTPException(status_code=404, detail="Car not found")
+    if fields is not None:
+        return ORJSONResponse(project(db_car, schemas.Car, fields))
     return db_car
 
 
 @router.post("/cars/", response_model=schemas.Car)
 def create_car(car: schemas.CarCreate, db: Session = Depends(get_db)):
-    db_car = crud.get_car(db, car_id=car.id)
-    if db_car is not None:
+    if crud.car_exists(db, car.id):
         raise HTTPException(status_code=400, detail="Car already exists")
-    return crud.create_car(db, car)
+    return write(db, crud.create_car, car)
+
+
+@router.post("/cars/bulk/", response_model=list[schemas.BulkCreateResult])
+def create_cars(cars: list[schemas.CarCreate], db: Session = Depends(get_db)):
+    ''' Creates many cars in one transaction. Cars that already exist are reported per item, and do not fail the request. '''
+    first_index = {}
+    for i, car in enumerate(cars):
+        first_index.setdefault(car.id, i)
+
+    inserted_ids = write(db, crud.create_cars, [cars[i] for i in first_index.values()])
+
+    results = []
+    for i, car in enumerate(cars):
+        if first_index[car.id] != i:
+            results.append(schemas.BulkCreateResult(index=i, id=car.id, created=False, detail="Car id is repeated in the request"))
+        elif car.id not in inserted_ids:
+            results.append(schemas.BulkCreateResult(index=i, id=car.id, created=False, detail="Car already exists"))
+        else:
+            results.append(schemas.BulkCreateResult(index=i, id=car.id, created=True))
+    return results
 
 
 # Charger
+@router.get("/chargers/", response_model=schemas.Page[schemas.Charger])
+def get_chargers(
+        after: Optional[int] = None, 
+        limit: int = Query(100, ge=1, le=1000), 
+        is_available: Optional[bool] = None,
+        is_reservable: Optional[bool] = None,
+        station_id: Optional[int] = None,
+        format: Literal["json", "ndjson"] = "json", 
+        fields: Optional[str] = None,
+        db: Session = Depends(get_db),
+    ):
+    fields = parse_fields(fields, schemas.Charger)
+    columns = projection_columns(models.Charger, fields)
+    def fetch_page(db, after, limit):
+        return crud.get_all_chargers(db, after, limit, is_available, is_reservable, station_id, columns)
+    return paginate(db, fetch_page, schemas.Charger, after, limit, format, fields)
+
+
 @router.get("/chargers/{charger_id}", response_model=schemas.Charger)
-def get_charger(charger_id: int, db: Session = Depends(get_db)):
-    db_charger = crud.get_charger(db, charger_id)
+def get_charger(
+        charger_id: int, 
+        request: Request, 
+        response: Response, 
+        reservations: schemas.ReservationWindow = Depends(get_reservation_window), 
+        fields: Optional[str] = None, 
+        db: Session = Depends(get_db),
+    ):
+    '''
+    The response has an ETag header. If the If-None-Match header of the request matches it, 
+    304 Not Modified is returned after only looking up the version of the charger.
+    '''
+    fields = parse_fields(fields, schemas.Charger)
+    version = crud.get_version(db, models.Charger, charger_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Charger not found")
+    etag = get_etag(version, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    columns = projection_columns(models.Charger, fields)
+    if columns is not None:
+        db_charger = crud.get_columns(db, models.Charger, charger_id, columns)
+    else:
+        db_charger = crud.get_charger(db, charger_id, reservations)
     if db_charger is None:
         raise HTTPException(status_code=404, detail="Charger not found")
+    if fields is not None:
+        return ORJSONResponse(project(db_charger, schemas.Charger, fields), headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return db_charger
 
 
@@ -48,28 +251,87 @@ def create_charger(charger: schemas.ChargerCreate, db: Session = Depends(get_db)
     if db_station is None:
         raise HTTPException(status_code=400, detail="Station of station_id does not exist")
     
-    return crud.create_charger(db, charger)
+    return write(db, crud.create_charger, charger)
+
+
+@router.post("/chargers/bulk/", response_model=list[schemas.BulkCreateResult])
+def create_chargers(chargers: list[schemas.ChargerCreate], db: Session = Depends(get_db)):
+    ''' Creates many chargers in one transaction. Chargers of stations that do not exist are reported per item, and are not created. '''
+    station_ids = crud.get_existing_charging_station_ids(db, [charger.station_id for charger in chargers])
+    valid_chargers = [charger for charger in chargers if charger.station_id in station_ids]
+    charger_ids = iter(write(db, crud.create_chargers, valid_chargers))
+
+    results = []
+    for i, charger in enumerate(chargers):
+        if charger.station_id in station_ids:
+            results.append(schemas.BulkCreateResult(index=i, id=next(charger_ids), created=True))
+        else:
+            results.append(schemas.BulkCreateResult(index=i, created=False, detail="Station of station_id does not exist"))
+    return results
+
+
+async def wait_for_delivery(delivery: Future):
+    ''' Waits for the delivery of an MQTT command on the event loop, so no worker thread is held while waiting. '''
+    try:
+        await asyncio.wrap_future(delivery)
+    except PublishError as e:
+        raise HTTPException(
+            status_code=504, 
+            detail=f"The start command was not acknowledged in time, the charger is made available again if it expires undelivered: {e}",
+        )
+
+
+def deactivate_expired_command(charger_id: int, station_id: int, command_id: int):
+    '''
+    Makes the charger available again when its start command expired before the broker acknowledged it (see mqtt.py),
+    whether or not the client waited for the delivery. The charger ignores the command if it still receives it.
+    '''
+    # Called from the MQTT delivery thread, so it uses its own session
+    db = SessionLocal()
+    try:
+        if write(db, crud.deactivate_charger, charger_id, command_id):
+            events.publish_availability(charger_id, station_id, True)
+            events.publish_session_stopped(charger_id, station_id)
+    finally:
+        db.close()
+
+
+def is_rejected(delivery: Future):
+    ''' True if the MQTT command was rejected when published, so it will never reach the charger. '''
+    return delivery.done() and delivery.exception() is not None
 
 
 @router.post("/chargers/{charger_id}/activate/", status_code=200)
-def activate_charger(activate_charger: schemas.ActivateCharger, charger_id: int, db: Session = Depends(get_db)):
+async def activate_charger(activate_charger: schemas.ActivateCharger, charger_id: int, db: Session = Depends(get_db)):
     '''
     This method will try to activate a given charger for a car.
     For non-reservable chargers, the charger must be available to start a charging session.
     For reservable chargers, the car must also have an reservation for the current 30-minute time slot.
+    With wait_for_delivery, the response is sent after the broker acknowledged the start command.
     '''
+    result, delivery = await run_in_threadpool(_activate_charger, activate_charger, charger_id, db)
+    if activate_charger.wait_for_delivery:
+        await wait_for_delivery(delivery)
+        result.delivered = True
+    return result
+
+
+def _activate_charger(activate_charger: schemas.ActivateCharger, charger_id: int, db: Session):
+    ''' The database part of activate_charger, run in a worker thread. Returns the response, and the Future of the command delivery. '''
     # Check if charger is valid
-    db_charger = crud.get_charger(db, charger_id)
+    db_charger = crud.get_charger_state(db, charger_id)
     if db_charger is None:
         raise HTTPException(status_code=404, detail="Charger not found")
     
     # Check of car is valid
-    db_car = crud.get_car(db, car_id=activate_charger.car_id)
-    if db_car is None:
+    if not crud.car_exists(db, activate_charger.car_id):
         raise HTTPException(status_code=400, detail="Car not found")
     
     if not db_charger.is_available:
-        raise HTTPException(status_code=400, detail="Charger currently is unavailable")
+        # The cached availability is stale if another server process made the charger available
+        db_charger = crud.get_charger_state(db, charger_id, use_cache=False)
+        if not db_charger.is_available:
+            raise HTTPException(status_code=400, detail="Charger currently is unavailable")
     
     if activate_charger.target_percentage > 100 or activate_charger.target_percentage <= 0:
         raise HTTPException(status_code=400, detail="Target percentage is not between 0 and 100.")
@@ -77,64 +339,235 @@ def activate_charger(activate_charger: schemas.ActivateCharger, charger_id: int,
     max_charging_time = 30 * 60 # 30 minutes in seconds
 
     if db_charger.is_reservable:
-        can_charge = False
-        reservation_end_time = None
-        if activate_charger.date_now is None:
-            for r in db_car.reservations:
-                if r.charger_id == charger_id and utils.is_now_in_range(r.start_time, r.end_time):
-                    can_charge = True
-                    reservation_end_time = r.end_time
-                    break
-        else:
-            for r in db_car.reservations:
-                if r.charger_id == charger_id and utils.is_datetime_in_range(activate_charger.date_now, r.start_time, r.end_time):
-                    can_charge = True
-                    reservation_end_time = r.end_time
-                    break
-
-        if can_charge:
-            max_charging_time = min(utils.get_seconds_until(reservation_end_time), 30 * 60)
+        date_now = activate_charger.date_now if activate_charger.date_now is not None else datetime.now()
+        db_reservation = crud.get_active_reservation(db, activate_charger.car_id, charger_id, date_now)
+
+        if db_reservation is not None:
+            max_charging_time = min(utils.get_seconds_until(db_reservation.end_time), 30 * 60)
         else:
             raise HTTPException(status_code=400, detail="The car has no reservation for the given charger at this time.")
 
-    # Charger is set to unavailable because the charging will start
-    crud.update_charger(db, charger_id, schemas.ChargerUpdate(is_available=False, is_reservable=None))
+    # Charger is set to unavailable because the charging will start.
+    # This fails if another car activated the charger after it was read above.
+    command_id = new_command_id()
+    if not write(db, crud.activate_charger, charger_id, command_id):
+        raise HTTPException(status_code=400, detail="Charger currently is unavailable")
 
     # Notify the charger to allow car to start charging
-    mqtt_client.send_start_charging_to_charger(charger_id, activate_charger.car_id, activate_charger.target_percentage, max_charging_time)
+    delivery = mqtt_client.send_start_charging_to_charger(
+        charger_id, command_id, activate_charger.car_id, activate_charger.target_percentage, max_charging_time,
+        on_expired=partial(deactivate_expired_command, charger_id, db_charger.station_id, command_id),
+    )
+    if is_rejected(delivery):
+        # The charger will never start, so it is made available again
+        write(db, crud.deactivate_charger, charger_id, command_id)
+        raise HTTPException(status_code=503, detail=f"The start command could not be sent to the charger: {delivery.exception()}")
 
-    return schemas.ActivateChargerReturn(max_charging_time=max_charging_time)
+    events.publish_availability(charger_id, db_charger.station_id, False)
+    events.publish_session_started(charger_id, db_charger.station_id, activate_charger.car_id, activate_charger.target_percentage, max_charging_time)
+
+    return schemas.ActivateChargerReturn(max_charging_time=max_charging_time), delivery
 
 
 @router.post("/chargers/{charger_id}/deactivate/", status_code=200)
-def activate_charger(charger_id: int, db: Session = Depends(get_db)):
-    ''' This method will make a charger available again, after charging is finished.'''
-    # Check if charger is valid
-    db_charger = crud.get_charger(db, charger_id)
+def activate_charger(charger_id: int, command_id: Optional[int] = None, db: Session = Depends(get_db)):
+    ''' 
+    This method will make a charger available again, after charging is finished.
+    The charger sends the id of the start command it is done with, and the request is ignored if the charger was activated again since.
+    '''
+    if write(db, crud.deactivate_charger, charger_id, command_id):
+        station_id = crud.get_charger_state(db, charger_id).station_id
+        events.publish_availability(charger_id, station_id, True)
+        events.publish_session_stopped(charger_id, station_id)
+        return
+
+    # The charger was not updated, find out why
+    db_charger = crud.get_charger_state(db, charger_id, use_cache=False)
     if db_charger is None:
         raise HTTPException(status_code=404, detail="Charger not found")
+    if not db_charger.is_available:
+        raise HTTPException(status_code=400, detail="Charger was activated with another command")
 
-    if db_charger.is_available:
-        raise HTTPException(status_code=404, detail="Charger is currently available")
-    
-    crud.update_charger(db, charger_id, schemas.ChargerUpdate(is_available=True, is_reservable=None))
+    raise HTTPException(status_code=404, detail="Charger is currently available")
 
 
 # Charging Station
+@router.get("/stations/", response_model=schemas.Page[schemas.ChargingStation])
+def get_stations(
+        after: Optional[int] = None, 
+        limit: int = Query(100, ge=1, le=1000), 
+        format: Literal["json", "ndjson"] = "json", 
+        fields: Optional[str] = None,
+        db: Session = Depends(get_db),
+    ):
+    fields = parse_fields(fields, schemas.ChargingStation)
+    columns = projection_columns(models.ChargingStation, fields)
+    def fetch_page(db, after, limit):
+        return crud.get_all_charging_stations(db, after, limit, columns)
+    return paginate(db, fetch_page, schemas.ChargingStation, after, limit, format, fields)
+
+
 @router.get("/stations/{station_id}", response_model=schemas.ChargingStation)
-def get_station(station_id: int, db: Session = Depends(get_db)):
-    db_station = crud.get_charging_station(db, station_id)
+def get_station(
+        station_id: int, 
+        request: Request, 
+        response: Response, 
+        reservations: schemas.ReservationWindow = Depends(get_reservation_window), 
+        fields: Optional[str] = None, 
+        db: Session = Depends(get_db),
+    ):
+    '''
+    The response has an ETag header. If the If-None-Match header of the request matches it, 
+    304 Not Modified is returned after only looking up the version of the charging station.
+    '''
+    fields = parse_fields(fields, schemas.ChargingStation)
+    version = crud.get_version(db, models.ChargingStation, station_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Charging station not found")
+    etag = get_etag(version, request)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    columns = projection_columns(models.ChargingStation, fields)
+    if columns is not None:
+        db_station = crud.get_columns(db, models.ChargingStation, station_id, columns)
+    else:
+        db_station = crud.get_charging_station(db, station_id, reservations)
     if db_station is None:
         raise HTTPException(status_code=404, detail="Charging station not found")
+    if fields is not None:
+        return ORJSONResponse(project(db_station, schemas.ChargingStation, fields), headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return db_station
 
 
+MAX_FREE_SLOT_DAYS = 14
+
+@router.get("/stations/{station_id}/free-slots", response_model=schemas.StationFreeSlots)
+def get_station_free_slots(station_id: int, start_date: date, end_date: Optional[date] = None, db: Session = Depends(get_db)):
+    '''
+    Returns the free 30-minute slots of every reservable charger of the station, from start_date to end_date (inclusive).
+    Slots that have already started are not free. The free slots are computed from the reserved slot bitmaps, 
+    so this takes three queries no matter how many reservations the chargers have.
+    '''
+    if end_date is None:
+        end_date = start_date
+    if end_date < start_date:
+        raise HTTPException(status_code=400, detail="end_date is before start_date.")
+    if (end_date - start_date).days >= MAX_FREE_SLOT_DAYS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_FREE_SLOT_DAYS} days can be requested at once.")
+
+    if crud.get_charging_station(db, station_id) is None:
+        raise HTTPException(status_code=404, detail="Charging station not found")
+
+    charger_ids = crud.get_reservable_charger_ids(db, station_id)
+    reserved_slots = crud.get_reserved_slots(db, charger_ids, start_date, end_date)
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    now = datetime.now()
+
+    chargers = []
+    for charger_id in charger_ids:
+        charger_days = []
+        for day in days:
+            free_slots = utils.get_free_slots_bitmap(reserved_slots.get((charger_id, day), 0), day, now)
+            charger_days.append(schemas.FreeSlotsDay(
+                day=day, 
+                free_slots=[utils.get_slot_start(day, slot) for slot in utils.get_slots_in_bitmap(free_slots)],
+            ))
+        chargers.append(schemas.ChargerFreeSlots(charger_id=charger_id, days=charger_days))
+
+    return schemas.StationFreeSlots(station_id=station_id, chargers=chargers)
+
+
+@router.get("/search/chargers", response_model=list[schemas.FreeCharger])
+def search_free_chargers(
+        car_id: str,
+        start: datetime,
+        end: datetime,
+        station_id: Optional[int] = None,
+        limit: int = Query(10, ge=1, le=100),
+        db: Session = Depends(get_db),
+    ):
+    '''
+    Returns the reservable chargers with the earliest free 30-minute slot between start and end, across all stations
+    or only those of station_id. Each charger is returned once, with its earliest free slot, sorted by the start of the slot.
+    Slots that have already started, and slots where the car already has a reservation, are not free.
+    The slots are read from the reserved slot bitmaps, so the reservations of the chargers are never loaded.
+    '''
+    if utils.is_date_aware(start) or utils.is_date_aware(end):
+        raise HTTPException(status_code=400, detail="start or end is aware, e.g. specified with a timezone. The dates should be naive.")
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end is not after start.")
+    if (end.date() - start.date()).days >= MAX_FREE_SLOT_DAYS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_FREE_SLOT_DAYS} days can be searched at once.")
+
+    if not crud.car_exists(db, car_id):
+        raise HTTPException(status_code=400, detail="Car of car_id does not exist")
+    if station_id is not None and crud.get_charging_station(db, station_id) is None:
+        raise HTTPException(status_code=404, detail="Charging station not found")
+
+    start_slot = max(utils.get_slot_after(start), utils.get_slot_after(datetime.now()))
+    end_slot = utils.get_slot(end - utils.SLOT_LENGTH) + 1 # slots ending at or before end
+    if end_slot <= start_slot:
+        return []
+
+    days = utils.get_slot_days(start_slot, end_slot)
+    window = {day: utils.get_window_slots_bitmap(day, start_slot, end_slot) for day in days}
+    car_slots = crud.get_cars_reserved_slots(db, [car_id], start_slot, end_slot)
+
+    chargers = crud.get_reservable_chargers(db, station_id)
+    reserved_slots = crud.get_reserved_slots(db, [charger.id for charger in chargers], days[0], days[-1])
+
+    found = []
+    for charger in chargers:
+        for day in days:
+            free_slots = window[day] & ~(reserved_slots.get((charger.id, day), 0) | car_slots.get((car_id, day), 0))
+            slot = utils.get_first_slot_in_bitmap(free_slots)
+            if slot is not None:
+                found.append((utils.get_slot_start(day, slot), charger.id, charger.station_id))
+                break
+
+    return [
+        schemas.FreeCharger(charger_id=charger_id, station_id=station_id, start_time=start_time, end_time=start_time + utils.SLOT_LENGTH)
+        for start_time, charger_id, station_id in heapq.nsmallest(limit, found)
+    ]
+
+
 @router.post("/stations/", response_model=schemas.ChargingStation)
 def create_station(db: Session = Depends(get_db)):
-    return crud.create_charging_station(db)
+    return write(db, crud.create_charging_station)
+
+
+@router.post("/stations/bulk/", response_model=list[schemas.BulkCreateResult])
+def create_stations(stations: schemas.ChargingStationBulkCreate, db: Session = Depends(get_db)):
+    ''' Creates the given number of charging stations in one transaction. '''
+    if stations.count <= 0:
+        raise HTTPException(status_code=400, detail="Count must be positive.")
+
+    station_ids = write(db, crud.create_charging_stations, stations.count)
+    return [schemas.BulkCreateResult(index=i, id=station_id, created=True) for i, station_id in enumerate(station_ids)]
 
 
 # Reservation
+@router.get("/reservations/", response_model=schemas.Page[schemas.Reservation])
+def get_reservations(
+        after: Optional[int] = None, 
+        limit: int = Query(100, ge=1, le=1000), 
+        car_id: Optional[str] = None,
+        charger_id: Optional[int] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        format: Literal["json", "ndjson"] = "json", 
+        db: Session = Depends(get_db),
+    ):
+    ''' The start and end parameters return the reservations overlapping the time window [start, end). '''
+    if (start is not None and utils.is_date_aware(start)) or (end is not None and utils.is_date_aware(end)):
+        raise HTTPException(status_code=400, detail="start or end is aware, e.g. specified with a timezone. The dates should be naive.")
+    def fetch_page(db, after, limit):
+        return crud.get_all_reservations(db, after, limit, car_id, charger_id, start, end)
+    return paginate(db, fetch_page, schemas.Reservation, after, limit, format)
+
+
 @router.get("/reservations/{reservation_id}", response_model=schemas.Reservation)
 def get_reservation(reservation_id: int, db: Session = Depends(get_db)):
     db_reservation = crud.get_reservation(db, reservation_id)
@@ -144,6 +577,26 @@ def get_reservation(reservation_id: int, db: Session = Depends(get_db)):
     return db_reservation
 
 
+def validate_reservation_time_slot(reservation: schemas.ReservationCreate):
+    ''' Raises a HTTPException if the time-slot of the reservation is not a future, aligned 30-minute slot. '''
+    if utils.is_date_aware(reservation.start_time) or utils.is_date_aware(reservation.end_time):
+        # Format of date should be: YYYY-MM-DDTHH:MM (ISO)
+        raise HTTPException(
+            status_code=400, 
+            detail="One of the datetimes are aware, e.g. specified with a timezone. The dates should be naive."
+            )
+    
+    if utils.is_date_passed(reservation.start_time) or utils.is_date_passed(reservation.end_time):
+        raise HTTPException(status_code=400, detail="One of the datetimes has already passed.")
+    
+    
+    if not (utils.is_valid_time(reservation.start_time) and utils.is_valid_time(reservation.end_time)):
+        raise HTTPException(status_code=400, detail="The start time or end time is not HH:30 or HH:00") 
+
+    if not utils.is_30_minutes(reservation.start_time, reservation.end_time):
+        raise HTTPException(status_code=400, detail="Time slot is not exactly 30 minutes long.")
+
+
 @router.post("/reservations/", response_model=schemas.Reservation)
 def create_reservation(reservation: schemas.ReservationCreate, db: Session = Depends(get_db)):
     '''
@@ -154,41 +607,189 @@ def create_reservation(reservation: schemas.ReservationCreate, db: Session = Dep
         * The charging time-slot must start either HH:00 or HH:30, and end exactly 30 minutes after
         * The charger cannot already be booked for the time-slot
     '''
-    db_car = crud.get_car(db, car_id=reservation.car_id)
-    if db_car is None:
+    if not crud.car_exists(db, reservation.car_id):
         raise HTTPException(status_code=400, detail="Car of car_id does not exist")
     
-    db_charger: models.Charger = crud.get_charger(db, reservation.charger_id)
+    db_charger = crud.get_charger_state(db, reservation.charger_id)
     if db_charger is None:
         raise HTTPException(status_code=404, detail="Charger of charger_id does not exist")
 
     if not db_charger.is_reservable:
         raise HTTPException(status_code=404, detail="Charger of charger_id is not reservable")
     
-    if utils.is_date_aware(reservation.start_time) or utils.is_date_aware(reservation.end_time):
-        # Format of date should be: YYYY-MM-DDTHH:MM (ISO)
-        raise HTTPException(
-            status_code=400, 
-            detail="One of the datetimes are aware, e.g. specified with a timezone. The dates should be naive."
-            )
-    
-    if utils.is_date_passed(reservation.start_time) or utils.is_date_passed(reservation.end_time):
-        raise HTTPException(status_code=400, detail="One of the datetimes has already passed.")
-    
-    
-    if not (utils.is_valid_time(reservation.start_time) and utils.is_valid_time(reservation.end_time)):
-        raise HTTPException(status_code=400, detail="The start time or end time is not HH:30 or HH:00") 
-
-    if not utils.is_30_minutes(reservation.start_time, reservation.end_time):
-        raise HTTPException(status_code=400, detail="Time slot is not exactly 30 minutes long.")
-    
+    validate_reservation_time_slot(reservation)
     
     # check if charger is already booked
-    for r in db_charger.reservations:
-        if r.start_time == reservation.start_time and r.end_time == reservation.end_time:
-            raise HTTPException(status_code=400, detail="Charger is already booked for the specified timeslot.")
+    if crud.is_charger_reserved(db, reservation.charger_id, reservation.start_time):
+        raise HTTPException(status_code=400, detail="Charger is already booked for the specified timeslot.")
+
+    db_reservation = write(db, crud.create_reservation, reservation)
+    if db_reservation is None:
+        raise HTTPException(status_code=400, detail="Charger is already booked for the specified timeslot.")
+
+    return db_reservation
+
+
+MAX_BATCH_RESERVATIONS = 1000
+BATCH_RESERVATION_ATTEMPTS = 3
+
+def _get_slot_request(index: int, request: schemas.BatchReservationRequest, car_ids: set, station_chargers: dict, now: datetime):
+    ''' Returns the planner.SlotRequest of a batch request, or the reason the request cannot be placed. '''
+    if request.car_id not in car_ids:
+        return "Car of car_id does not exist"
+    if utils.is_date_aware(request.start) or utils.is_date_aware(request.end):
+        return "start or end is aware, e.g. specified with a timezone. The dates should be naive."
+    if request.end <= request.start:
+        return "end is not after start."
+    if (request.end.date() - request.start.date()).days >= MAX_FREE_SLOT_DAYS:
+        return f"The window is longer than {MAX_FREE_SLOT_DAYS} days."
+
+    start_slot = max(utils.get_slot_after(request.start), utils.get_slot_after(now))
+    end_slot = utils.get_slot(request.end - utils.SLOT_LENGTH) + 1
+    if end_slot <= start_slot:
+        return "The window has no 30-minute slot that has not started yet."
+
+    station_ids = station_chargers.keys() if request.station_ids is None else request.station_ids
+    charger_ids = sorted(charger_id for station_id in station_ids for charger_id in station_chargers.get(station_id, []))
+    if not charger_ids:
+        return "There are no reservable chargers at the given stations."
+
+    return planner.SlotRequest(index, request.car_id, start_slot, end_slot, charger_ids)
+
+
+@router.post("/reservations/batch/", response_model=list[schemas.BatchReservationResult])
+def create_reservations(requests: list[schemas.BatchReservationRequest], db: Session = Depends(get_db)):
+    '''
+    Books one 30-minute slot for every car of the batch, in the given window and at one of the given stations.
+    The slots are assigned in one pass over the reserved slot bitmaps (see planner.py), so the assignment has no conflicts,
+    and all reservations are committed in one transaction.
+    Requests that cannot be placed are reported per item, and do not fail the request.
+    '''
+    if len(requests) > MAX_BATCH_RESERVATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_RESERVATIONS} reservations can be requested at once.")
+
+    now = datetime.now()
+    car_ids = crud.get_existing_car_ids(db, [request.car_id for request in requests])
+    station_chargers = defaultdict(list)
+    for charger in crud.get_reservable_chargers(db):
+        station_chargers[charger.station_id].append(charger.id)
+
+    results = {}
+    slot_requests = []
+    for i, request in enumerate(requests):
+        slot_request = _get_slot_request(i, request, car_ids, station_chargers, now)
+        if isinstance(slot_request, str):
+            results[i] = schemas.BatchReservationResult(index=i, car_id=request.car_id, placed=False, detail=slot_request)
+        else:
+            slot_requests.append(slot_request)
+
+    if slot_requests:
+        start_slot = min(request.start_slot for request in slot_requests)
+        end_slot = max(request.end_slot for request in slot_requests)
+        days = utils.get_slot_days(start_slot, end_slot)
+        charger_ids = sorted({charger_id for request in slot_requests for charger_id in request.charger_ids})
+
+        for attempt in range(BATCH_RESERVATION_ATTEMPTS):
+            # Ends the read transaction of the previous attempt, so the reservations that conflicted are seen
+            db.rollback()
+            reserved_slots = crud.get_reserved_slots(db, charger_ids, days[0], days[-1])
+            car_slots = crud.get_cars_reserved_slots(db, [request.car_id for request in slot_requests], start_slot, end_slot)
+            planned = planner.plan_reservations(slot_requests, reserved_slots, car_slots)
+
+            reservations = []
+            for index, (charger_id, slot) in planned.items():
+                start_time = utils.get_slot_start(utils.get_slot_day(slot), utils.get_slot_of_day(slot))
+                reservations.append(schemas.ReservationCreate(
+                    start_time=start_time, end_time=start_time + utils.SLOT_LENGTH, car_id=requests[index].car_id, charger_id=charger_id
+                ))
+            db_reservations = write(db, crud.create_reservations, reservations)
+            if db_reservations is not None:
+                break
+        else:
+            raise HTTPException(status_code=409, detail="The chargers were booked by other requests while planning, try again.")
+
+        for index, db_reservation in zip(planned.keys(), db_reservations):
+            results[index] = schemas.BatchReservationResult(index=index, car_id=db_reservation.car_id, placed=True, reservation=db_reservation)
+        for request in slot_requests:
+            if request.index not in results:
+                results[request.index] = schemas.BatchReservationResult(
+                    index=request.index, car_id=request.car_id, placed=False, detail="No free slot in the window at the given stations."
+                )
 
-    return crud.create_reservation(db, reservation)
+    return [results[i] for i in range(len(requests))]
+
+
+# Events
+@router.get("/events")
+async def stream_events(charger_id: Optional[list[int]] = Query(None), station_id: Optional[list[int]] = Query(None)):
+    '''
+    Streams the events of the given chargers and stations as server-sent events, or of all chargers if none are given.
+    Events are sent when the availability of a charger changes, and when a charging session starts or stops (see events.py).
+    '''
+    subscription = events.broker.subscribe(charger_id, station_id)
+
+    async def stream():
+        try:
+            while True:
+                event = await subscription.get(timeout=config.EVENT_KEEPALIVE)
+                if event is None:
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"event: " + event["type"].encode() + b"\ndata: " + orjson.dumps(event) + b"\n\n"
+        finally:
+            events.broker.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/events/ws")
+async def stream_events_ws(websocket: WebSocket, charger_id: Optional[list[int]] = Query(None), station_id: Optional[list[int]] = Query(None)):
+    ''' The same events as GET /events, sent as one JSON text message per event over a WebSocket. '''
+    await websocket.accept()
+    subscription = events.broker.subscribe(charger_id, station_id)
+    try:
+        while True:
+            event = await subscription.get(timeout=config.EVENT_KEEPALIVE)
+            await websocket.send_text(orjson.dumps(event if event is not None else {"type": "keepalive"}).decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        events.broker.unsubscribe(subscription)
+
+
+@router.get("/events/stats", status_code=200)
+def get_event_stats():
+    ''' Number of subscribers, and of published and dropped events, for this server process. '''
+    return events.broker.stats()
+
+
+@router.get("/mqtt/stats", status_code=200)
+def get_mqtt_stats():
+    ''' Counters of the start commands published by this server process, see mqtt.py. '''
+    return mqtt_client.publish_stats()
+
+
+@router.get("/cache/stats", status_code=200)
+def get_cache_stats():
+    ''' Hit and miss counters of the car and charger cache, for this server process. '''
+    return {"cars": cache.car_cache.stats(), "chargers": cache.charger_cache.stats()}
+
+
+@router.get("/ready")
+def ready(db: Session = Depends(get_db)):
+    '''
+    Readiness of this server process, with the database and the MQTT broker reported separately.
+    The status code is 503 unless both are ready. The broker is not ready while the client is still connecting, or reconnecting.
+    '''
+    try:
+        db.query(models.Charger.id).limit(1).all() # also fails if the tables have not been created
+        database = {"ready": True, "detail": None}
+    except SQLAlchemyError as e:
+        database = {"ready": False, "detail": str(e.__cause__ or e)}
+    broker = mqtt_client.status()
+
+    status_code = 200 if database["ready"] and broker["ready"] else 503
+    return ORJSONResponse({"database": database, "broker": broker}, status_code=status_code)
 
 
 @router.get("/hello", status_code=200)
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+import config
+
+"""
+This file contains the event broker, which pushes charger events to the clients subscribed to the /events endpoints.
+The endpoints publish an event when the availability of a charger changes, and when a charging session starts or stops.
+
+Publishing never blocks the endpoint. Every subscriber has a bounded queue, and a subscriber that falls so far behind
+that its queue is full gets a single 'resync' event instead of the events it missed. The client should then read
+the current state from the GET endpoints.
+"""
+
+RESYNC_EVENT = {"type": "resync"}
+
+
+class Subscription:
+    ''' The events of the chargers in charger_ids and the stations in station_ids, or of all chargers if both are empty. '''
+    def __init__(self, loop: asyncio.AbstractEventLoop, charger_ids: set, station_ids: set, queue_size: int):
+        self.loop = loop
+        self.charger_ids = charger_ids
+        self.station_ids = station_ids
+        self.queue = asyncio.Queue(max(queue_size, 1))
+        self.dropped = 0
+
+
+    def deliver(self, event: dict):
+        ''' Queues the event. Must be called from the event loop of the subscriber. '''
+        if self.queue.full():
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_EVENT)
+            return
+        self.queue.put_nowait(event)
+
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        ''' Waits for the next event. Returns None if no event arrived within timeout seconds. '''
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroker:
+    def __init__(self, queue_size: int = config.EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        # Subscriptions are indexed by charger and station, so publishing only visits the interested subscribers
+        self.by_charger = defaultdict(set)
+        self.by_station = defaultdict(set)
+        self.unfiltered = set()
+        self.published = 0
+        self.dropped = 0 # events dropped by subscriptions that have ended
+
+
+    def subscribe(self, charger_ids: Optional[list[int]] = None, station_ids: Optional[list[int]] = None) -> Subscription:
+        ''' Must be called from the event loop that will read the subscription. '''
+        subscription = Subscription(asyncio.get_running_loop(), set(charger_ids or []), set(station_ids or []), self.queue_size)
+        with self.lock:
+            self.subscriptions.add(subscription)
+            if not subscription.charger_ids and not subscription.station_ids:
+                self.unfiltered.add(subscription)
+            for charger_id in subscription.charger_ids:
+                self.by_charger[charger_id].add(subscription)
+            for station_id in subscription.station_ids:
+                self.by_station[station_id].add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            if subscription not in self.subscriptions:
+                return
+            self.subscriptions.remove(subscription)
+            self.dropped += subscription.dropped
+            self.unfiltered.discard(subscription)
+            for charger_id in subscription.charger_ids:
+                self.by_charger[charger_id].discard(subscription)
+                if not self.by_charger[charger_id]:
+                    del self.by_charger[charger_id]
+            for station_id in subscription.station_ids:
+                self.by_station[station_id].discard(subscription)
+                if not self.by_station[station_id]:
+                    del self.by_station[station_id]
+
+
+    def publish(self, event: dict):
+        ''' Sends the event to the interested subscribers. Can be called from any thread. '''
+        with self.lock:
+            self.published += 1
+            subscriptions = self.unfiltered | self.by_charger.get(event["charger_id"], set()) | self.by_station.get(event["station_id"], set())
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError: # the event loop of the subscriber is closed
+                self.unsubscribe(subscription)
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscriptions),
+                "published": self.published,
+                "dropped": self.dropped + sum(subscription.dropped for subscription in self.subscriptions),
+            }
+
+
+broker = EventBroker()
+
+
+def _event(type: str, charger_id: int, station_id: int, **fields):
+    return {"type": type, "charger_id": charger_id, "station_id": station_id, "time": datetime.now().isoformat(), **fields}
+
+
+def publish_availability(charger_id: int, station_id: int, is_available: bool):
+    broker.publish(_event("availability", charger_id, station_id, is_available=is_available))
+
+
+def publish_session_started(charger_id: int, station_id: int, car_id: str, battery_target: int, max_charging_time: int):
+    broker.publish(_event(
+        "session_started", charger_id, station_id, car_id=car_id, battery_target=battery_target, max_charging_time=max_charging_time
+    ))
+
+
+def publish_session_stopped(charger_id: int, station_id: int):
+    broker.publish(_event("session_stopped", charger_id, station_id))
@@ -0,0 +1,76 @@
+from datetime import date
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+import crud
+import models
+import utils
+from database import engine
+
+"""
+This file contains the steps that bring an existing database file up to date with the models, run when the server starts.
+create_all() only creates the tables that are missing, so anything that changes an existing table, 
+or derives data from existing rows, is done here.
+"""
+
+
+def create_missing_indexes():
+    ''' create_all() skips tables that already exist, so indexes added to the models later are created here. '''
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+# Indexes replaced by the ones on reservations.slot
+OBSOLETE_INDEXES = ["ix_reservations_charger_start", "ix_reservations_car_charger_time"]
+
+
+def add_reservation_slots():
+    ''' Adds the slot column to a reservations table created before it existed, and computes it from start_time. '''
+    columns = {column["name"] for column in inspect(engine).get_columns(models.Reservation.__tablename__)}
+    with engine.begin() as connection:
+        if "slot" not in columns:
+            connection.exec_driver_sql("ALTER TABLE reservations ADD COLUMN slot INTEGER")
+        # start_time is naive, and so is the slot epoch, so the unix time of start_time gives the slot
+        connection.exec_driver_sql(
+            f"UPDATE reservations SET slot = CAST(strftime('%s', start_time) AS INTEGER) / {utils.SLOT_MINUTES * 60} WHERE slot IS NULL"
+        )
+        for index in OBSOLETE_INDEXES:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+
+
+def add_version_columns():
+    ''' Adds the version column to charger and station tables created before it existed. '''
+    tables = [
+        model.__tablename__ for model in (models.Charger, models.ChargingStation) 
+        if "version" not in {column["name"] for column in inspect(engine).get_columns(model.__tablename__)}
+    ]
+    with engine.begin() as connection:
+        for table in tables:
+            connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+
+def add_command_id_column():
+    ''' Adds the command_id column to a chargers table created before it existed. '''
+    if "command_id" in {column["name"] for column in inspect(engine).get_columns(models.Charger.__tablename__)}:
+        return
+    with engine.begin() as connection:
+        connection.exec_driver_sql("ALTER TABLE chargers ADD COLUMN command_id INTEGER")
+
+
+def migrate():
+    ''' Creates the database file if not present, and migrates an existing one. '''
+    existing_tables = set(inspect(engine).get_table_names())
+
+    models.Base.metadata.create_all(bind=engine)
+    if models.Reservation.__tablename__ in existing_tables:
+        add_reservation_slots()
+    add_version_columns()
+    add_command_id_column()
+    create_missing_indexes()
+
+    if models.ChargerSlotDay.__tablename__ not in existing_tables:
+        # The slot bitmaps are new, fill them from the reservations made before.
+        # Bound to the engine, since SessionLocal is read-only when the write coordinator is on.
+        with Session(bind=engine) as db:
+            crud.rebuild_reserved_slots(db, since=date.today())
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, DateTime, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -20,6 +20,8 @@ class Charger(Base):
     id = Column(Integer, primary_key=True)
     is_reservable = Column(Boolean, default=False)
     is_available = Column(Boolean, default=True)
+    version = Column(Integer, default=1, nullable=False) # incremented by every write that changes the charger, see crud.py
+    command_id = Column(Integer) # id of the start command sent when the charger was activated, see crud._set_charger_availability
 
     station_id = Column(Integer, ForeignKey("stations.id"))
 
@@ -30,19 +32,39 @@ class ChargingStation(Base):
     __tablename__ = "stations"
 
     id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=1, nullable=False) # incremented when the station or one of its chargers changes
 
     chargers = relationship("Charger", back_populates="station")
 
 
 class Reservation(Base):
     __tablename__ = "reservations"
+    __table_args__ = (
+        # A charger can only be booked once per time-slot.
+        Index("ix_reservations_charger_slot", "charger_id", "slot", unique=True),
+        # Used when looking up the reservation a car is activating a charger with.
+        Index("ix_reservations_car_charger_slot", "car_id", "charger_id", "slot"),
+    )
 
     id = Column(Integer, primary_key=True)
     start_time = Column(DateTime())
     end_time = Column(DateTime())
+    slot = Column(Integer) # index of the 30-minute slot of the reservation, see utils.get_slot()
 
     car_id = Column(String, ForeignKey("cars.id"))
     charger_id = Column(Integer, ForeignKey("chargers.id"))
 
     car = relationship("Car", back_populates="reservations")
     charger = relationship("Charger", back_populates="reservations")
+
+
+class ChargerSlotDay(Base):
+    ''' 
+    Bitmap of the reserved 30-minute slots of a charger on a day, kept up to date when reservations are created.
+    Bit n is set if the slot starting n*30 minutes after midnight is reserved (see utils.py).
+    '''
+    __tablename__ = "charger_slot_days"
+
+    charger_id = Column(Integer, ForeignKey("chargers.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    reserved_slots = Column(Integer, default=0, nullable=False)
@@ -1,45 +1,228 @@
 import paho.mqtt.client as mqtt
-import json
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, NamedTuple, Optional
+import config
 
-MQTT_BROKER = "test.mosquitto.org"
-MQTT_PORT = 1883
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")) # see common/messages.py
+import messages
+
+MQTT_BROKER = config.MQTT_BROKER
+MQTT_PORT = config.MQTT_PORT
 CHARGER_TOPIC = "ttm4115/g11/chargers"
+CLIENT_ID_PREFIX = "ttm4115-g11-server"
+
+
+class PublishError(Exception):
+    ''' The message was not delivered: it was rejected when published, or not acknowledged in time. '''
+    pass
+
+
+def get_client_id():
+    '''
+    A client id that is unique per server process. The broker disconnects a client when another one connects with the same id,
+    so the workers of a server can not share one.
+    '''
+    return f"{CLIENT_ID_PREFIX}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def new_command_id():
+    ''' A random id for a start command, which the charger reports back when it is deactivated. Never 0, which means no id. '''
+    return secrets.randbelow(0xFFFFFFFF) + 1
+
+
+class InFlight(NamedTuple):
+    info: mqtt.MQTTMessageInfo
+    future: Optional[Future] # None once the delivery timed out
+    deadline: float # monotonic time at which the delivery times out
+    expiry: float # monotonic time at which the message is no longer tracked, at or after the deadline
+    on_expired: Optional[Callable[[], None]]
+
 
 class MQTTClient:
-    def __init__(self):
-        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+    def __init__(self, client_id: Optional[str] = None, host: str = MQTT_BROKER, port: int = MQTT_PORT):
+        self.client_id = client_id if client_id is not None else get_client_id()
+        self.host = host
+        self.port = port
+        self.connected = False
+        self.last_error = None
+        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1, client_id=self.client_id)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_connect_fail = self.on_connect_fail
+        self.client.reconnect_delay_set(config.MQTT_RECONNECT_MIN_DELAY, config.MQTT_RECONNECT_MAX_DELAY)
+
+        # Publish pipeline, see publish()
+        self.qos = config.MQTT_QOS
+        self.max_queued = config.MQTT_MAX_QUEUED
+        self.ack_timeout = config.MQTT_ACK_TIMEOUT
+        self.command_ttl = max(config.MQTT_COMMAND_TTL, self.ack_timeout)
+        self.client.max_queued_messages_set(self.max_queued)
+        self.client.on_publish = self.on_publish
+        self.lock = threading.Lock()
+        self.in_flight = {} # mid -> InFlight
+        self.acknowledged_early = {} # mid -> monotonic time, of messages acknowledged before publish() registered them
+        self.metrics = {"published": 0, "delivered": 0, "rejected": 0, "timed_out": 0, "expired": 0}
+        self.stopped = threading.Event()
+        self.sweeper = None
 
     def on_connect(self, client, userdata, flags, rc):
         print("on_connect(): {}".format(mqtt.connack_string(rc)))
+        self.connected = rc == 0
+        self.last_error = None if rc == 0 else mqtt.connack_string(rc)
+
+    def on_connect_fail(self, client, userdata):
+        self.last_error = "Could not reach {}:{}".format(self.host, self.port)
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0: # not a disconnect() call, the network loop reconnects
+            print("on_disconnect(): {}".format(mqtt.error_string(rc)))
+            self.last_error = mqtt.error_string(rc)
 
     def on_message(self, msg):
         return # Server does not subscribe to any topics
 
-    
-    def send_start_charging_to_charger(self, charger_id: int, car_id: str, battery_target: int, max_charging_time: int):
-        payload = {
-            "command": "start_charging",
-            "car_id": car_id,
-            "battery_target": battery_target,
-            "max_charging_time": max_charging_time,
-        }
-        payload = json.dumps(payload)
+    def on_publish(self, client, userdata, mid):
+        ''' Called by the network loop when the broker acknowledged a message (QoS 1 and 2), or when it was sent (QoS 0). '''
+        with self.lock:
+            entry = self.in_flight.pop(mid, None)
+            if entry is not None:
+                self.metrics["delivered"] += 1
+            else:
+                # Acknowledged between client.publish() returning and publish() registering the message.
+                # paho marks the message as published only after this callback, so publish() checks these mids instead.
+                # Late acknowledgements of messages that are no longer tracked also end up here, and are pruned by _sweep().
+                self.acknowledged_early[mid] = time.monotonic()
+        if entry is not None and entry.future is not None:
+            entry.future.set_result(True)
 
-        self.client.publish(f"{CHARGER_TOPIC}/{charger_id}", payload)
+
+    def publish(self, topic: str, payload: str, qos: Optional[int] = None, ttl: Optional[float] = None, on_expired: Optional[Callable[[], None]] = None) -> Future:
+        '''
+        Publishes the payload without waiting for the network, and returns a Future of its delivery. 
+        The future is resolved with True when the message is delivered, or fails with a PublishError if the message was rejected 
+        (the queue is full, or QoS 0 while disconnected) or was not acknowledged within ack_timeout seconds.
+        A message that times out may still be delivered later. With a ttl, the message is tracked for ttl seconds, 
+        and on_expired is called from the delivery thread if it was not acknowledged by then.
+        '''
+        qos = self.qos if qos is None else qos
+        future = Future()
+        with self.lock:
+            queue_full = len(self.in_flight) >= self.max_queued
+        info = None if queue_full else self.client.publish(topic, payload, qos=qos)
+
+        # At QoS 1 and 2, paho keeps a message published while disconnected, and sends it after reconnecting
+        if queue_full or info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN) or (qos == 0 and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            error = mqtt.error_string(mqtt.MQTT_ERR_QUEUE_SIZE if queue_full else info.rc)
+            with self.lock:
+                self.metrics["rejected"] += 1
+            future.set_exception(PublishError(f"Message to {topic} was rejected: {error}"))
+            return future
+
+        with self.lock:
+            self.metrics["published"] += 1
+            # on_publish only resolves registered messages, so a message acknowledged before this point is resolved here
+            delivered = self.acknowledged_early.pop(info.mid, None) is not None
+            if delivered:
+                self.metrics["delivered"] += 1
+            else:
+                now = time.monotonic()
+                expiry = now + max(ttl or 0, self.ack_timeout)
+                self.in_flight[info.mid] = InFlight(info, future, now + self.ack_timeout, expiry, on_expired)
+        if delivered:
+            future.set_result(True)
+        return future
+
+
+    def _sweep(self):
+        ''' 
+        Fails the deliveries that were not acknowledged within ack_timeout seconds, and stops tracking the messages that expired.
+        An early acknowledgement is picked up by publish() right away, so older ones are of messages that are no longer tracked.
+        They are dropped, since paho reuses their mids once it wraps around.
+        '''
+        interval = min(self.ack_timeout / 4, 0.5)
+        while not self.stopped.wait(interval):
+            now = time.monotonic()
+            with self.lock:
+                futures, expired = [], []
+                for mid, entry in list(self.in_flight.items()):
+                    if entry.expiry <= now:
+                        expired.append(self.in_flight.pop(mid))
+                    if entry.deadline <= now and entry.future is not None:
+                        futures.append(entry.future)
+                        if mid in self.in_flight:
+                            self.in_flight[mid] = entry._replace(future=None)
+                for mid in [mid for mid, acknowledged in self.acknowledged_early.items() if acknowledged <= now - interval]:
+                    del self.acknowledged_early[mid]
+                self.metrics["timed_out"] += len(futures)
+                self.metrics["expired"] += len(expired)
+            for future in futures:
+                future.set_exception(PublishError(f"Message was not acknowledged within {self.ack_timeout} seconds"))
+            for entry in expired:
+                if entry.on_expired is not None:
+                    entry.on_expired()
+
+
+    def send_start_charging_to_charger(
+            self, charger_id: int, command_id: int, car_id: str, battery_target: int, max_charging_time: int, 
+            on_expired: Optional[Callable[[], None]] = None,
+        ) -> Future:
+        ''' 
+        Returns the Future of the delivery of the command, see publish(). 
+        The command expires command_ttl seconds after it was published. paho still sends it after that if the broker was unreachable,
+        but the charger ignores it, and reports the command_id to the server so the charger is made available again.
+        on_expired is called if the broker did not acknowledge the command before it expired, so it is taken as not received.
+        '''
+        expires_at = time.time() + self.command_ttl
+        try:
+            payload = messages.encode(messages.StartCharging(car_id, battery_target, max_charging_time, command_id, expires_at))
+        except messages.MessageError as e:
+            # Rejected like a message that could not be published, so the activation is rolled back
+            with self.lock:
+                self.metrics["rejected"] += 1
+            future = Future()
+            future.set_exception(PublishError(str(e)))
+            return future
+
+        return self.publish(f"{CHARGER_TOPIC}/{charger_id}", payload, ttl=self.command_ttl, on_expired=on_expired)
 
 
     def start(self):
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        print("Connecting to {}:{}".format(MQTT_BROKER, MQTT_PORT))
-        self.client.connect(MQTT_BROKER, MQTT_PORT)
+        ''' 
+        Connects in the background, so the server starts even if the broker is unreachable. 
+        The network loop retries until the connection succeeds, and reconnects if the connection is lost. 
+        '''
+        print("Connecting to {}:{} as {}".format(self.host, self.port, self.client_id))
+        self.client.connect_async(self.host, self.port)
         self.client.loop_start()
+        self.stopped.clear()
+        self.sweeper = threading.Thread(target=self._sweep, name="mqtt-delivery-timeouts", daemon=True)
+        self.sweeper.start()
     
 
     def stop(self):
         self.client.disconnect()
+        self.client.loop_stop()
+        self.stopped.set()
+        if self.sweeper is not None:
+            self.sweeper.join()
+
+
+    def status(self):
+        return {"ready": self.connected, "host": self.host, "port": self.port, "client_id": self.client_id, "detail": self.last_error}
+
+
+    def publish_stats(self):
+        with self.lock:
+            return {**self.metrics, "in_flight": len(self.in_flight), "max_queued": self.max_queued, "qos": self.qos, "command_ttl": self.command_ttl}
 
     
         
\ No newline at end of file
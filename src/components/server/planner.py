@@ -0,0 +1,46 @@
+from typing import NamedTuple
+
+import utils
+
+"""
+This file contains the planner of the batch reservation endpoint, which assigns the cars of a batch to free charger slots.
+The planner only works on the reserved slot bitmaps, so a whole batch is planned without querying the database.
+"""
+
+
+class SlotRequest(NamedTuple):
+    index: int # index of the request in the batch
+    car_id: str
+    start_slot: int
+    end_slot: int # the request can be placed in the slots from start_slot up to (not including) end_slot
+    charger_ids: list[int] # the chargers the request can be placed at
+
+
+def plan_reservations(requests: list[SlotRequest], reserved_slots: dict, car_slots: dict):
+    '''
+    Gives every request the earliest free slot in its window, at one of its chargers. Returns {index: (charger_id, slot)}
+    of the requests that were placed. reserved_slots {(charger_id, day): bitmap} and car_slots {(car_id, day): bitmap}
+    are updated with the planned reservations, so a car is never planned twice for the same slot.
+
+    The requests are placed earliest deadline first, and the request with the narrowest window first on equal deadlines.
+    A request whose window ends early then does not lose its only free slots to a request that could have waited.
+    '''
+    planned = {}
+    for request in sorted(requests, key=lambda r: (r.end_slot, r.end_slot - r.start_slot, r.index)):
+        for day in utils.get_slot_days(request.start_slot, request.end_slot):
+            window = utils.get_window_slots_bitmap(day, request.start_slot, request.end_slot)
+            window &= ~car_slots.get((request.car_id, day), 0)
+
+            earliest = None
+            for charger_id in request.charger_ids:
+                slot = utils.get_first_slot_in_bitmap(window & ~reserved_slots.get((charger_id, day), 0))
+                if slot is not None and (earliest is None or slot < earliest[1]):
+                    earliest = (charger_id, slot)
+
+            if earliest is not None:
+                charger_id, slot = earliest
+                reserved_slots[(charger_id, day)] = reserved_slots.get((charger_id, day), 0) | 1 << slot
+                car_slots[(request.car_id, day)] = car_slots.get((request.car_id, day), 0) | 1 << slot
+                planned[request.index] = (charger_id, utils.get_first_slot_of_day(day) + slot)
+                break
+    return planned
@@ -1,17 +1,54 @@
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 import uvicorn
 import endpoints
-import models
-from database import SessionLocal, engine
+import config
+import migrations
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ''' Starts the MQTT client and write coordinator of this server process, and stops them on shutdown '''
+    endpoints.mqtt_client.start()
+    if endpoints.write_coordinator is not None:
+        endpoints.write_coordinator.start()
+    yield
+    if endpoints.write_coordinator is not None:
+        endpoints.write_coordinator.stop()
+    endpoints.mqtt_client.stop()
+
+
+def create_app():
+    ''' Creates the FastAPI application, with the endpoints of the configured database mode '''
+    app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan) # orjson encodes responses several times faster than json
+    if config.DATABASE_MODE == "async":
+        import async_endpoints
+        app.include_router(async_endpoints.router) # takes precedence over the sync versions of the same endpoints
+    app.include_router(endpoints.router)
+    return app
+
 
 def run():
     ''' Starts the server '''
 
-    models.Base.metadata.create_all(bind=engine) # Creates database file, if not present
+    migrations.migrate() # Creates database file, if not present
 
-    app = FastAPI()
-    app.include_router(endpoints.router)
-    uvicorn.run(app, host="127.0.0.1", port=8000, log_level="info")
+    if config.WORKERS > 1:
+        # Every worker process imports this file and creates its own app, which connects its own MQTT client
+        uvicorn.run(
+            "run:create_app", 
+            factory=True, 
+            workers=config.WORKERS, 
+            app_dir=os.path.dirname(os.path.abspath(__file__)), 
+            host=config.SERVER_HOST, 
+            port=config.SERVER_PORT, 
+            log_level="info",
+        )
+    else:
+        app = create_app()
+        uvicorn.run(app, host=config.SERVER_HOST, port=config.SERVER_PORT, log_level="info")
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
-from datetime import datetime
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import date, datetime
+from typing import Generic, Optional, TypeVar, Union
 
 """
 This file contains the formats of data returned from the server, and received by the server.
@@ -23,8 +23,17 @@ class ReservationCreate(ReservationBase):
 class Reservation(ReservationBase):
     id: int
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+class ReservationWindow(BaseModel):
+    ''' 
+    Limits the reservations embedded in a car, charger or station. 
+    Only reservations overlapping [reservations_from, reservations_until) are included, 
+    and at most reservations_limit per car or charger, earliest first.
+    '''
+    reservations_from: Optional[datetime] = None
+    reservations_until: Optional[datetime] = None
+    reservations_limit: Optional[int] = Field(None, ge=0)
 
 # Car
 class BaseCar(BaseModel):
@@ -36,8 +45,7 @@ class CarCreate(BaseCar):
 class Car(BaseCar):
     reservations: list[Reservation]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 
@@ -61,23 +69,86 @@ class Charger(ChargerBase):
     reservations: list[Reservation]
     is_available: bool
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ActivateCharger(BaseModel):
     car_id: str
     target_percentage: int
     date_now: Optional[datetime] # field used for debugging, TODO: remove it later.
+    wait_for_delivery: bool = False # respond only after the broker acknowledged the start command sent to the charger
 
 
 class ActivateChargerReturn(BaseModel):
     max_charging_time: int # max time to charge in seconds
+    delivered: Optional[bool] = None # True if wait_for_delivery was set, and the command was acknowledged
 
 # Charger Station
 class ChargingStation(BaseModel):
     id: int
     chargers: list[Charger]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+# Bulk creation
+class BulkCreateResult(BaseModel):
+    ''' The result for one item of a bulk creation, in the same order as the items of the request. '''
+    index: int
+    id: Optional[Union[int, str]] = None
+    created: bool
+    detail: Optional[str] = None
+
+
+class ChargingStationBulkCreate(BaseModel):
+    count: int
+
+
+# Pagination
+PageItem = TypeVar("PageItem")
+
+class Page(BaseModel, Generic[PageItem]):
+    ''' A page of a list endpoint. next_cursor is passed as 'after' to get the next page, and is None on the last page. '''
+    items: list[PageItem]
+    next_cursor: Optional[Union[int, str]] = None
+
+
+# Free slots
+class FreeSlotsDay(BaseModel):
+    day: date
+    free_slots: list[datetime] # start times of the free 30-minute slots
+
+
+class ChargerFreeSlots(BaseModel):
+    charger_id: int
+    days: list[FreeSlotsDay]
+
+
+class StationFreeSlots(BaseModel):
+    station_id: int
+    chargers: list[ChargerFreeSlots]
+
+
+# Charger search
+class FreeCharger(BaseModel):
+    charger_id: int
+    station_id: int
+    start_time: datetime # start of the earliest free 30-minute slot of the charger in the searched window
+    end_time: datetime
+
+
+# Batch reservations
+class BatchReservationRequest(BaseModel):
+    ''' A car that needs one 30-minute slot between start and end, at one of station_ids, or at any station if station_ids is not given. '''
+    car_id: str
+    start: datetime
+    end: datetime
+    station_ids: Optional[list[int]] = None
+
+
+class BatchReservationResult(BaseModel):
+    index: int # index of the request in the batch
+    car_id: str
+    placed: bool
+    reservation: Optional[Reservation] = None
+    detail: Optional[str] = None
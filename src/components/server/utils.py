@@ -1,4 +1,6 @@
-from datetime import datetime
+import math
+from datetime import date, datetime, timedelta
+from typing import Optional
 
 
 
@@ -17,7 +19,7 @@ def is_valid_time(d: datetime):
 
 
 def is_30_minutes(start: datetime, end: datetime):
-    return (end-start).seconds == 1800
+    return end - start == SLOT_LENGTH
 
 def is_date_aware(d: datetime):
     return d.tzinfo is not None and d.tzinfo.utcoffset(d) is not None
@@ -35,4 +37,72 @@ def is_datetime_in_range(dt: datetime, start: datetime, end: datetime):
 def get_seconds_until(dt: datetime) -> int:
     now = datetime.now()
     delta = dt - now
-    return int(delta.total_seconds())
\ No newline at end of file
+    return int(delta.total_seconds())
+
+
+# Reservation slots
+# Every reservation is exactly one 30-minute slot. A slot is stored as its index counted from 1970-01-01 00:00 (naive),
+# so the slot starting at 1970-01-01 00:30 is slot 1. A day has 48 slots, and the reserved slots of a charger on a day 
+# are stored as a bitmap, where bit n is set if the slot starting n*30 minutes after midnight is reserved.
+SLOT_MINUTES = 30
+SLOT_LENGTH = timedelta(minutes=SLOT_MINUTES)
+SLOTS_PER_DAY = 48
+FULL_DAY_SLOTS = (1 << SLOTS_PER_DAY) - 1
+SLOT_EPOCH = datetime(1970, 1, 1)
+
+def get_slot(d: datetime) -> int:
+    ''' Index of the slot containing d. '''
+    return (d - SLOT_EPOCH) // SLOT_LENGTH
+
+def get_slot_after(d: datetime) -> int:
+    ''' Index of the first slot starting at or after d. The slots overlapping [start, end) are get_slot(start) <= slot < get_slot_after(end). '''
+    return -((SLOT_EPOCH - d) // SLOT_LENGTH)
+
+def get_slot_day(slot: int) -> date:
+    return (SLOT_EPOCH + timedelta(days=slot // SLOTS_PER_DAY)).date()
+
+def get_slot_of_day(slot: int) -> int:
+    return slot % SLOTS_PER_DAY
+
+def get_first_slot_of_day(day: date) -> int:
+    return get_slot(datetime.combine(day, datetime.min.time()))
+
+def get_slot_start(day: date, slot_of_day: int) -> datetime:
+    return datetime.combine(day, datetime.min.time()) + slot_of_day * SLOT_LENGTH
+
+def get_slots_in_bitmap(bitmap: int) -> list[int]:
+    return [slot for slot in range(SLOTS_PER_DAY) if bitmap >> slot & 1]
+
+def get_passed_slots_bitmap(day: date, now: datetime) -> int:
+    ''' Bitmap of the slots of the day that started before now. '''
+    if day < now.date():
+        return FULL_DAY_SLOTS
+    if day > now.date():
+        return 0
+    elapsed = now - datetime.combine(day, datetime.min.time())
+    passed_slots = math.ceil(elapsed.total_seconds() / (SLOT_MINUTES * 60))
+    return (1 << passed_slots) - 1
+
+def get_free_slots_bitmap(reserved_slots: int, day: date, now: datetime) -> int:
+    ''' Bitmap of the slots of the day that are neither reserved nor started before now. '''
+    return FULL_DAY_SLOTS & ~(reserved_slots | get_passed_slots_bitmap(day, now))
+
+def get_window_slots_bitmap(day: date, start_slot: int, end_slot: int) -> int:
+    ''' Bitmap of the slots of the day from start_slot up to (not including) end_slot. '''
+    first_slot = get_first_slot_of_day(day)
+    start = max(start_slot - first_slot, 0)
+    end = min(end_slot - first_slot, SLOTS_PER_DAY)
+    if end <= start:
+        return 0
+    return (1 << end) - (1 << start)
+
+def get_first_slot_in_bitmap(bitmap: int) -> Optional[int]:
+    ''' The lowest set bit of the bitmap, or None if no bit is set. '''
+    if bitmap == 0:
+        return None
+    return (bitmap & -bitmap).bit_length() - 1
+
+def get_slot_days(start_slot: int, end_slot: int) -> list[date]:
+    ''' The days of the slots from start_slot up to (not including) end_slot. '''
+    start_day, end_day = get_slot_day(start_slot), get_slot_day(end_slot - 1)
+    return [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
@@ -0,0 +1,166 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+
+import config
+from database import SQLALCHEMY_DATABASE_URL, set_sqlite_pragmas
+
+"""
+This file contains the write coordinator, which executes all writes to the database from a single thread.
+Writes are queued by the endpoints, and the writer groups the pending writes into one transaction (group commit),
+so a burst of writes costs one commit instead of one commit, and one fight over the SQLite write lock, per write.
+"""
+
+
+class _BatchSession:
+    '''
+    Session given to the crud methods executed by the writer.
+    Every write runs in its own SAVEPOINT, so commit() only flushes the write and rollback() only undoes the write,
+    while the batch is committed as a whole by the writer afterwards.
+    '''
+    def __init__(self, db: Session):
+        self._db = db
+        self._savepoint = db.begin_nested()
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def commit(self):
+        self._db.flush()
+
+    def rollback(self):
+        self.close_savepoint(success=False)
+
+    def refresh(self, instance):
+        return # primary keys and column defaults are already set by the flush
+
+    def close_savepoint(self, success: bool):
+        if self._closed:
+            return
+        self._closed = True
+        if success:
+            self._savepoint.commit()
+        else:
+            self._savepoint.rollback()
+
+
+class WriteCoordinator:
+    def __init__(self, batch_size: int = config.WRITE_BATCH_SIZE, batch_delay: float = config.WRITE_BATCH_DELAY):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay / 1000 # seconds
+        self.queue = queue.Queue()
+        self.thread = None
+        self.running = False
+
+        self.engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+        if config.SQLITE_TUNING == "on":
+            set_sqlite_pragmas(self.engine, config.SQLITE_PRAGMAS)
+
+        # pysqlite does not handle SAVEPOINT correctly by itself, so transactions are started explicitly.
+        # IMMEDIATE takes the write lock at the start of the batch instead of at the first write.
+        @event.listens_for(self.engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(self.engine, "begin")
+        def on_begin(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+        # Objects are returned to other threads after the commit, so they are not expired
+        self.SessionLocal = sessionmaker(autoflush=False, expire_on_commit=False, bind=self.engine)
+
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name="write-coordinator", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        self.queue.put(None) # wakes up the writer
+        if self.thread:
+            self.thread.join()
+        self.engine.dispose()
+
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        ''' Queues fn(db, *args, **kwargs) to be executed by the writer. The returned future holds the result of fn. '''
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+
+    def execute(self, fn, *args, **kwargs):
+        ''' Queues a write and waits for the batch containing it to be committed. '''
+        return self.submit(fn, *args, **kwargs).result()
+
+
+    def _loop(self):
+        while self.running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._execute_batch(batch)
+            except Exception as e:
+                print(f"Write coordinator failed to execute a batch of {len(batch)} writes: {e}")
+                for future, _, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+    def _next_batch(self):
+        ''' Waits for a write, and then collects writes until the batch is full or the batch delay has passed. '''
+        write = self.queue.get()
+        if write is None:
+            return []
+        batch = [write]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                write = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is None:
+                break
+            batch.append(write)
+        return batch
+
+
+    def _execute_batch(self, batch: list):
+        results = []
+        db = self.SessionLocal()
+        try:
+            for future, fn, args, kwargs in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                batch_db = _BatchSession(db)
+                try:
+                    result = fn(batch_db, *args, **kwargs)
+                except Exception as e:
+                    batch_db.close_savepoint(success=False)
+                    future.set_exception(e)
+                    continue
+                batch_db.close_savepoint(success=True)
+                results.append((future, result))
+
+            try:
+                db.commit()
+            except Exception as e:
+                print(f"Write coordinator failed to commit a batch of {len(results)} writes: {e}")
+                db.rollback()
+                for future, _ in results:
+                    future.set_exception(e)
+                return
+        finally:
+            db.close() # detaches the returned objects from the session
+
+        for future, result in results:
+            future.set_result(result)